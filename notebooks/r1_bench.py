@@ -0,0 +1,435 @@
+"""
+r1_bench.py — benchmarks for the R1 toy machinery in `r1_toy.py`.
+
+Each function runs one comparison from a notebook cell (or a REPL) and
+returns a small stats dict: the fast path against the plain one, plus a
+check that both give the same answers where that is expected.
+
+    import r1_bench as RB
+    RB.decode_benchmark(model)            # KV cache vs full recompute
+    RB.rollout_benchmark(model)           # GRPO step time and graph memory
+"""
+
+import os
+import re
+import sys
+import copy
+import time
+import random
+import tempfile
+import subprocess
+import numpy as np
+import torch
+import torch.nn.functional as F
+import r1_toy as R
+import r1_numpy
+
+
+def decode_benchmark(model, max_new=16, repeats=3):
+    """
+    Greedy tokens/sec over all 100 prompts, full recompute vs KV cache.
+    Runs with dropout off so both paths are deterministic; `same_tokens`
+    checks they produce identical outputs.
+    """
+    prompts = [f'{a}+{b}=' for a in range(10) for b in range(10)]
+    stats, outs = {}, {}
+    with R.eval_mode(model):
+        for name, use_cache in (('full', False), ('cached', True)):
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                outs[name] = [R.generate(model, p, max_new, use_cache) for p in prompts]
+            dt = time.perf_counter() - t0
+            n_tok = repeats * sum(len(o) - len(p) for o, p in zip(outs[name], prompts))
+            stats[f'{name}_tok_per_s'] = n_tok / dt
+    stats['speedup'] = stats['cached_tok_per_s'] / stats['full_tok_per_s']
+    stats['same_tokens'] = outs['full'] == outs['cached']
+    return stats
+
+
+def data_benchmark(strings, k=16, steps=2000):
+    """Microseconds per SFT batch: re-encoding with pad_batch vs SFTDataset."""
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        R.pad_batch(random.choices(strings, k=k))
+    per_step_strings = (time.perf_counter() - t0) / steps
+    ds = R.SFTDataset(strings)
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        ds.batch(k)
+    per_step_tensor = (time.perf_counter() - t0) / steps
+    return {'pad_batch_us': per_step_strings * 1e6,
+            'dataset_us': per_step_tensor * 1e6,
+            'speedup': per_step_strings / per_step_tensor}
+
+
+def packing_benchmark(strings, k=16, steps=200):
+    """Loss-bearing target tokens per SFT step (and per computed position),
+    padded batches vs packed rows."""
+    padded, packed = R.SFTDataset(strings), R.PackedSFTDataset(strings)
+    draws = {'padded': lambda: (padded.batch(k), None), 'packed': lambda: packed.batch(k)}
+    out = {}
+    for name, draw in draws.items():
+        useful = computed = 0
+        for _ in range(steps):
+            y = R.lm_targets(*draw())
+            useful += (y != R.PAD).sum().item()
+            computed += y.numel()
+        out[f'{name}_useful_per_step'] = useful / steps
+        out[f'{name}_useful_frac'] = useful / computed
+    return out
+
+
+@torch.no_grad()
+def grammar_benchmark(model, max_tries=32, temperature=1.0):
+    """
+    Samples-to-first-correct per prompt, free vs grammar-constrained
+    sampling: `max_tries` samples for each of the 100 prompts in one batch,
+    counting draws up to the first correct answer (max_tries + 1 if none).
+    Also reports the fraction of samples that were well-formed at all.
+    """
+    pairs = [(a, b) for a in range(10) for b in range(10)]
+    prompts = [f'{a}+{b}=' for a, b in pairs for _ in range(max_tries)]
+    fmt = re.compile(r'\d\+\d=T\d\+\d A\d\d?\.$')
+    out = {}
+    for name, constrained in (('free', False), ('constrained', True)):
+        texts = R.sample_batch(model, prompts, temperature=temperature, constrained=constrained)
+        ok = torch.tensor([R.extract_answer(t) == a + b for t, (a, b) in
+                           zip(texts, (p for p in pairs for _ in range(max_tries)))])
+        ok = ok.view(len(pairs), max_tries)
+        first = torch.where(ok.any(1), ok.float().argmax(1) + 1, torch.tensor(max_tries + 1))
+        out[f'{name}_samples_to_first_correct'] = first.float().mean().item()
+        out[f'{name}_well_formed'] = sum(bool(fmt.match(t)) for t in texts) / len(texts)
+    return out
+
+
+def _saved_tensor_bytes():
+    """Context manager + counter: bytes autograd saves for the backward."""
+    counter = [0]
+
+    def pack(t):
+        counter[0] += t.numel() * t.element_size()
+        return t
+    return torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t), counter
+
+
+def rollout_benchmark(model, P=8, G=16, steps=5):
+    """
+    GRPO step time and autograd memory, log-probs kept while sampling vs
+    sample-then-score (`rescore=True`). Each mode trains its own copy of
+    `model`. Also checks, with dropout off, that the re-scored log-probs
+    match the ones accumulated during sampling (`logp_max_abs_diff`).
+    """
+    out = {}
+    for name, rescore in (('in_loop', False), ('rescore', True)):
+        m = copy.deepcopy(model)
+        trainer = R.GRPOTrainer(m, torch.optim.AdamW(m.parameters(), lr=1e-4), P, G,
+                              rescore=rescore)
+        prompts = [R.random_prompt()[0] for _ in range(P)]
+        hooks, saved = _saved_tensor_bytes()
+        with hooks:
+            trainer.rollout(prompts)
+        times = [trainer.step()['step_time'] for _ in range(steps)]
+        out[f'{name}_step_s'] = sum(times) / steps
+        out[f'{name}_graph_MB'] = saved[0] / 2 ** 20
+    with R.eval_mode(model):
+        trainer = R.GRPOTrainer(model, None, P, G)
+        seqs, valid, gen_mask, sampled = trainer.rollout([R.random_prompt()[0] for _ in range(P)])
+        with torch.no_grad():
+            scored = R.sequence_logprobs(model, seqs, valid, gen_mask)
+    out['logp_max_abs_diff'] = (sampled.detach() - scored).abs().max().item()
+    return out
+
+
+def filter_benchmark(model, P=8, G=4, steps=50, resample_rounds=2):
+    """
+    GRPO with every group kept vs zero-variance groups dropped vs dropped
+    and refilled (dynamic sampling). Each mode trains its own copy of
+    `model`; reports the mean zero-variance fraction, groups that reached
+    the backward per step, step time, and the final exhaustive pass-rate.
+    """
+    out = {}
+    for name, filt, rounds in (('all', False, 0), ('skip', True, 0),
+                               ('resample', True, resample_rounds)):
+        m = copy.deepcopy(model)
+        trainer = R.GRPOTrainer(m, torch.optim.AdamW(m.parameters(), lr=1e-4), P, G,
+                              filter_groups=filt, resample_rounds=rounds)
+        hist = [trainer.step() for _ in range(steps)]
+        out[name] = {
+            'zero_var_frac': sum(h['zero_var_frac'] for h in hist) / steps,
+            'groups_per_step': sum(h['groups_used'] for h in hist) / steps,
+            'step_s': sum(h['step_time'] for h in hist) / steps,
+            'pass_rate': R.exact_pass_rate(m)[0],
+        }
+    return out
+
+
+def allocation_benchmark(model, budget=32, G=4, rollouts=4000, eval_every=1000, lr=1e-4):
+    """
+    Pass-rate per rollouts spent: fixed groups (budget//G prompts x G, the
+    `GRPOTrainer` default shape) vs `AdaptiveGRPOTrainer` with the same
+    budget per step, visiting as many prompts with groups of G on average.
+    Each trains its own copy of `model`; returns {'fixed': [(rollouts,
+    pass_rate), ...], 'adaptive': [...]}, one point every `eval_every`
+    rollouts.
+    """
+    out = {}
+    for name in ('fixed', 'adaptive'):
+        m = copy.deepcopy(model)
+        opt = torch.optim.AdamW(m.parameters(), lr=lr)
+        if name == 'fixed':
+            trainer = R.GRPOTrainer(m, opt, P=budget // G, G=G)
+        else:
+            trainer = R.AdaptiveGRPOTrainer(m, opt, R.GroupAllocator(budget, G))
+        curve, done, mark = [(0, R.exact_pass_rate(m)[0])], 0, eval_every
+        while done < rollouts:
+            done += trainer.step()['rollouts']
+            if done >= mark:
+                curve.append((done, R.exact_pass_rate(m)[0]))
+                mark += eval_every
+        out[name] = curve
+    return out
+
+
+def curriculum_benchmark(model, target=0.9, temperature=1.0, P=8, G=4, max_rollouts=20000,
+                         eval_every=10, lr=1e-4):
+    """
+    Rollouts until the exhaustive pass-rate first reaches `target`: uniform
+    `random_prompt` draws vs a `CurriculumSampler` at `temperature`. Each
+    trains its own copy of `model` (checked every `eval_every` steps);
+    None means the target was not reached within `max_rollouts`.
+    """
+    out = {}
+    for name in ('uniform', 'curriculum'):
+        m = copy.deepcopy(model)
+        sampler = R.CurriculumSampler(temperature) if name == 'curriculum' else None
+        trainer = R.GRPOTrainer(m, torch.optim.AdamW(m.parameters(), lr=lr), P, G,
+                              sampler=sampler)
+        done, hit = 0, None
+        while done < max_rollouts and hit is None:
+            for _ in range(eval_every):
+                done += trainer.step()['rollouts']
+            if R.exact_pass_rate(m)[0] >= target:
+                hit = done
+        out[name] = {'rollouts_to_target': hit, 'final_pass_rate': R.exact_pass_rate(m)[0]}
+    return out
+
+
+def reuse_benchmark(model, epochs=(1, 2, 4), clip=0.2, P=8, G=4, steps=40, lr=1e-4):
+    """
+    Rollout reuse: the same number of sampled rollouts (steps * P * G),
+    each batch used for 1..K clipped-surrogate epochs. Each setting trains
+    its own copy of `model`; reports the final exhaustive pass-rate (so
+    pass-rate per rollout at equal sampling cost), step time, and the mean
+    KL drift and clip fraction.
+    """
+    out = {}
+    for K in epochs:
+        m = copy.deepcopy(model)
+        trainer = R.GRPOTrainer(m, torch.optim.AdamW(m.parameters(), lr=lr), P, G,
+                              epochs=K, clip=clip)
+        hist = [trainer.step() for _ in range(steps)]
+        out[K] = {
+            'pass_rate': R.exact_pass_rate(m)[0],
+            'rollouts': steps * P * G,
+            'step_s': sum(h['step_time'] for h in hist) / steps,
+            'kl': sum(h.get('kl', 0.0) for h in hist) / steps,
+            'clip_frac': sum(h.get('clip_frac', 0.0) for h in hist) / steps,
+        }
+    return out
+
+
+def kl_benchmark(model, ref_model, kl_coef=0.05, P=8, G=4, steps=30, lr=1e-4):
+    """
+    Cost of the reference-KL term: GRPO step time without it (sampling with
+    grad, and sample-then-score with rescore=True, the path the KL term
+    uses) vs with it. Each run trains its own copy of `model`. `ref_s` is
+    the reference scoring pass per step; `overhead` is the KL run's step
+    time over the rescore run's, minus 1.
+    """
+    out = {}
+    for name, kw in (('no_kl', {}), ('rescore', {'rescore': True}),
+                     ('kl', {'ref_model': ref_model, 'kl_coef': kl_coef})):
+        m = copy.deepcopy(model)
+        trainer = R.GRPOTrainer(m, torch.optim.AdamW(m.parameters(), lr=lr), P, G, **kw)
+        hist = [trainer.step() for _ in range(steps)]
+        out[name] = {'step_s': sum(h['step_time'] for h in hist) / steps}
+        if name == 'kl':
+            out[name]['ref_s'] = sum(h['ref_time'] for h in hist) / steps
+            out[name]['ref_kl'] = hist[-1]['ref_kl']
+    out['overhead'] = out['kl']['step_s'] / out['rescore']['step_s'] - 1
+    return out
+
+
+def distill_benchmark(teacher, student, strings, T=2.0, top_k=None, k=16, steps=100):
+    """
+    Distillation step time (loss + backward), running the teacher every
+    step vs reading cached soft targets. Both paths see the same batches,
+    so `max_loss_diff` is the largest gap between their KL values (zero
+    up to float error when dense; with `top_k` it is the KL the tail drops).
+    Teacher and student both run with dropout off.
+    """
+    naive = R.SFTDataset(strings)
+    t0 = time.perf_counter()
+    cached = R.DistillDataset(teacher, strings, T, top_k)
+    build = time.perf_counter() - t0
+    losses = {'naive': [], 'cached': []}
+    times = {}
+    with R.eval_mode(teacher), R.eval_mode(student):   # no dropout noise in the diff
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            x = naive.batch(k)
+            with torch.no_grad():
+                t = F.softmax(teacher(x[:, :-1]) / T, -1)
+            loss = R.distill_loss(student, x, t, T)
+            loss.backward()
+            losses['naive'].append(loss.item())
+        times['naive'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            loss = R.distill_loss(student, *cached.batch(k), T)
+            loss.backward()
+            losses['cached'].append(loss.item())
+        times['cached'] = time.perf_counter() - t0
+    student.zero_grad()
+    return {
+        'naive_step_ms': times['naive'] / steps * 1e3,
+        'cached_step_ms': times['cached'] / steps * 1e3,
+        'cache_build_ms': build * 1e3,
+        'speedup': times['naive'] / times['cached'],
+        'max_loss_diff': max(abs(a - b) for a, b in zip(losses['naive'], losses['cached'])),
+    }
+
+
+def speculative_benchmark(teacher, draft, k=4, temperature=1.0, greedy=True):
+    """
+    Plain teacher decoding vs speculative decoding over all 100 prompts
+    (dropout off): draft acceptance rate, tokens per teacher pass, wall
+    time and speed-up. In greedy mode also checks the outputs are identical.
+    """
+    prompts = [f'{a}+{b}=' for a in range(10) for b in range(10)]
+    with R.eval_mode(teacher), R.eval_mode(draft):
+        t0 = time.perf_counter()
+        if greedy:
+            plain = [R.generate(teacher, p) for p in prompts]
+        else:
+            plain = [R.sample_text(teacher, p, temperature=temperature) for p in prompts]
+        t_plain = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        spec = [R.speculative_generate(teacher, draft, p, k=k, temperature=temperature,
+                                     greedy=greedy) for p in prompts]
+        t_spec = time.perf_counter() - t0
+    drafted = sum(st['drafted'] for _, st in spec)
+    n_tok = sum(len(t) - len(p) for (t, _), p in zip(spec, prompts))
+    out = {
+        'acceptance_rate': sum(st['accepted'] for _, st in spec) / max(drafted, 1),
+        'tokens_per_teacher_call': n_tok / sum(st['teacher_calls'] for _, st in spec),
+        'plain_ms': t_plain * 1e3,
+        'speculative_ms': t_spec * 1e3,
+        'speedup': t_plain / t_spec,
+    }
+    if greedy:
+        out['same_tokens'] = plain == [t for t, _ in spec]
+    return out
+
+
+def quantization_benchmark(model, repeats=5):
+    """
+    fp32 `model` vs its dynamic-int8 copy on CPU: exhaustive pass-rate for
+    both (accuracy parity), how many of the 100 greedy outputs agree,
+    single-prompt latency and batched throughput.
+    """
+    qmodel = R.load_quantized(model.state_dict(), **model.config())
+    prompts = [f'{a}+{b}=' for a in range(10) for b in range(10)]
+    out = {}
+    with R.eval_mode(model):
+        for name, m in (('fp32', model), ('int8', qmodel)):
+            out[f'{name}_pass_rate'] = R.exact_pass_rate(m)[0]
+            t0 = time.perf_counter()
+            for p in prompts[:20]:
+                R.generate(m, p)
+            out[f'{name}_latency_ms'] = (time.perf_counter() - t0) / 20 * 1e3
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                outs = R.generate_batch(m, prompts)
+            out[f'{name}_prompts_per_s'] = repeats * len(prompts) / (time.perf_counter() - t0)
+            out[f'{name}_outputs'] = outs
+    fp, q = out.pop('fp32_outputs'), out.pop('int8_outputs')
+    out['greedy_agreement'] = sum(a == b for a, b in zip(fp, q)) / len(fp)
+    out['speedup'] = out['int8_prompts_per_s'] / out['fp32_prompts_per_s']
+    return out
+
+
+def inference_benchmark(model, repeats=5):
+    """
+    CPU comparison of the training module against the `FusedTinyLM`
+    backends: full-sequence forward time on a (100, BLOCK) batch, batched
+    greedy decoding throughput, max logit difference and whether greedy
+    outputs match. 'script' only changes the full-sequence forward (its
+    decoding is the 'sdpa' path), so it gets no decode numbers. A backend
+    that cannot run here (e.g. torch.compile without a C++ toolchain) is
+    reported as `<mode>_error`.
+    """
+    prompts = [f'{a}+{b}=' for a in range(10) for b in range(10)]
+    x = torch.randint(R.V, (len(prompts), R.BLOCK))
+    out = {}
+    with R.eval_mode(model), torch.no_grad():
+        ref_logits, ref_out = model(x), R.generate_batch(model, prompts)
+        for mode in ('module', 'sdpa', 'script', 'compile'):
+            try:
+                m = model if mode == 'module' else R.FusedTinyLM(model, mode)
+                diff = (m(x) - ref_logits).abs().max().item()   # also warms up
+                t0 = time.perf_counter()
+                for _ in range(repeats):
+                    m(x)
+                fwd = (time.perf_counter() - t0) / repeats
+                dec = None
+                if mode != 'script':
+                    t0 = time.perf_counter()
+                    for _ in range(repeats):
+                        outs = R.generate_batch(m, prompts)
+                    dec = (time.perf_counter() - t0) / repeats
+            except Exception as e:    # optional backends may be unavailable
+                out[f'{mode}_error'] = repr(e)
+                continue
+            out[f'{mode}_forward_ms'] = fwd * 1e3
+            out[f'{mode}_max_logit_diff'] = diff
+            if dec is not None:
+                out[f'{mode}_decode_prompts_per_s'] = len(prompts) / dec
+                out[f'{mode}_same_tokens'] = outs == ref_out
+    return out
+
+
+def numpy_benchmark(model, path=None, repeats=5):
+    """
+    Torch vs the pure-NumPy engine (`r1_numpy`): interpreter start-up time
+    to import each stack (fresh subprocess), max logit difference, greedy
+    agreement and batched decoding throughput over the 100 prompts. The
+    exported weights go to `path` (default: a temporary file).
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        return _numpy_benchmark(model, path or os.path.join(tmp, 'tinylm.npz'), repeats)
+
+
+def _numpy_benchmark(model, path, repeats):
+    R.export_numpy(model, path)
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = {}
+    for name, stmt in (('torch', 'import r1_toy'), ('numpy', 'import r1_numpy')):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', stmt], cwd=here, check=True)
+        out[f'{name}_startup_s'] = time.perf_counter() - t0
+    np_model = r1_numpy.NumpyTinyLM(path)
+    prompts = [f'{a}+{b}=' for a in range(10) for b in range(10)]
+    x = torch.randint(R.V, (len(prompts), R.BLOCK))
+    with R.eval_mode(model), torch.no_grad():
+        ref = model(x).numpy()
+        out['max_logit_diff'] = float(np.abs(np_model.forward(x.numpy()) - ref).max())
+        for name, run in (('torch', lambda: R.generate_batch(model, prompts)),
+                          ('numpy', lambda: np_model.generate_batch(prompts))):
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                outs = run()
+            out[f'{name}_prompts_per_s'] = repeats * len(prompts) / (time.perf_counter() - t0)
+            out[f'{name}_outputs'] = outs
+    out['same_tokens'] = out.pop('torch_outputs') == out.pop('numpy_outputs')
+    return out
@@ -0,0 +1,195 @@
+"""
+r1_numpy.py — torch-free TinyLM inference for lightweight evaluation workers.
+
+`r1_toy.py` needs PyTorch, and importing torch costs far more than scoring a
+~100K-parameter model. This module re-implements `TinyLM`'s forward pass
+(post-norm transformer blocks, erf-based GELU, KV-cached decoding) in plain
+NumPy, so an eval job only has to import NumPy.
+
+Weights come from `r1_toy.export_numpy(model, 'tinylm.npz')`, which stores
+the state_dict arrays together with the architecture and the vocabulary, so
+nothing here depends on `r1_toy`:
+
+    python r1_numpy.py tinylm.npz --workers 4     # exhaustive pass-rate
+"""
+
+import re
+import json
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+
+def _erf(x):
+    """Abramowitz & Stegun 7.1.26 (max abs error 1.5e-7); NumPy has no erf."""
+    a = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * a)
+    poly = ((((1.061405429 * t - 1.453152027) * t + 1.421413741) * t
+             - 0.284496736) * t + 0.254829592) * t
+    return np.sign(x) * (1.0 - poly * np.exp(-a * a))
+
+
+def _gelu(x):
+    return 0.5 * x * (1.0 + _erf(x / np.sqrt(2.0)))
+
+
+def _layer_norm(x, w, b, eps):
+    mu = x.mean(-1, keepdims=True)
+    var = ((x - mu) ** 2).mean(-1, keepdims=True)
+    return (x - mu) / np.sqrt(var + eps) * w + b
+
+
+def extract_answer(text):
+    """Pull the integer inside the 'A...' answer marker, or None."""
+    m = re.search(r'A(\d+)\.', text)
+    return int(m.group(1)) if m else None
+
+
+class NumpyTinyLM:
+    """A TinyLM loaded from an `export_numpy` .npz file; inference only."""
+
+    def __init__(self, path):
+        z = np.load(path)
+        self.w = {k: z[k] for k in z.files if not k.startswith('__')}
+        self.cfg = json.loads(z['__config__'].item())
+        self.vocab = z['__vocab__'].item()
+        self.stoi = {c: i for i, c in enumerate(self.vocab)}
+        self.eos = self.stoi['.']
+
+    def encode(self, s):
+        return [self.stoi[c] for c in s]
+
+    def decode(self, ids):
+        return ''.join(self.vocab[i] for i in ids)
+
+    def _block(self, i, h, past, mask):
+        w, p = self.w, f'blocks.{i}.'
+        B, T, d = h.shape
+        nh = self.cfg['h']
+        qkv = h @ w[p + 'self_attn.in_proj_weight'].T + w[p + 'self_attn.in_proj_bias']
+        q, k, v = (t.reshape(B, T, nh, d // nh).transpose(0, 2, 1, 3)
+                   for t in np.split(qkv, 3, -1))
+        if past is not None:
+            k, v = np.concatenate([past[0], k], 2), np.concatenate([past[1], v], 2)
+        att = q @ k.transpose(0, 1, 3, 2) / np.sqrt(d // nh)
+        if mask is not None:
+            att = np.where(mask, att, -np.inf)
+        att = np.exp(att - att.max(-1, keepdims=True))
+        att /= att.sum(-1, keepdims=True)
+        a = (att @ v).transpose(0, 2, 1, 3).reshape(B, T, d)
+        a = a @ w[p + 'self_attn.out_proj.weight'].T + w[p + 'self_attn.out_proj.bias']
+        h = _layer_norm(h + a, w[p + 'norm1.weight'], w[p + 'norm1.bias'], self.cfg['eps'])
+        ff = _gelu(h @ w[p + 'linear1.weight'].T + w[p + 'linear1.bias'])
+        ff = ff @ w[p + 'linear2.weight'].T + w[p + 'linear2.bias']
+        h = _layer_norm(h + ff, w[p + 'norm2.weight'], w[p + 'norm2.bias'], self.cfg['eps'])
+        return h, (k, v)
+
+    def forward(self, x, cache=None):
+        """
+        Logits (B, T, V) for equal-length rows of token ids `x` (B, T). With a
+        `cache` list (filled in place) only the new tokens are run, exactly
+        like `TinyLM.forward_cached`.
+        """
+        P = cache[0][0].shape[2] if cache else 0
+        T = x.shape[1]
+        h = self.w['tok.weight'][x] + self.w['pos.weight'][P:P + T]
+        mask = np.tril(np.ones((T, P + T), dtype=bool), P) if T > 1 else None
+        layers = []
+        for i in range(self.cfg['L']):
+            h, kv = self._block(i, h, cache[i] if P else None, mask)
+            layers.append(kv)
+        if cache is not None:
+            cache[:] = layers
+        return h @ self.w['head.weight'].T + self.w['head.bias']
+
+    def _decode_equal_length(self, prompts, max_new, temperature, rng):
+        x = np.array([self.encode(p) for p in prompts])
+        if x.shape[1] + max_new > self.cfg['block']:
+            raise ValueError(f"prompt + max_new must fit in block={self.cfg['block']}")
+        cache = []
+        logits = self.forward(x, cache)[:, -1]
+        gen = np.full((len(prompts), max_new), -1)
+        done = np.zeros(len(prompts), dtype=bool)
+        for t in range(max_new):
+            if temperature is None:
+                nxt = logits.argmax(-1)
+            else:
+                z = logits / temperature
+                p = np.exp(z - z.max(-1, keepdims=True))
+                c = (p / p.sum(-1, keepdims=True)).cumsum(-1)
+                c[:, -1] = 1.0
+                nxt = (rng.random((len(c), 1)) < c).argmax(-1)
+            gen[:, t] = np.where(done, -1, nxt)
+            done |= nxt == self.eos
+            if done.all():
+                break
+            logits = self.forward(nxt[:, None], cache)[:, -1]
+        return [p + self.decode([i for i in row if i >= 0]) for p, row in zip(prompts, gen)]
+
+    def generate_batch(self, prompts, max_new=16, temperature=None, seed=0):
+        """
+        Decode many prompts, batched per prompt length; greedy unless a
+        `temperature` is given. Same strings as `r1_toy.generate_batch`.
+        """
+        rng = np.random.default_rng(seed)
+        by_len = {}
+        for i, p in enumerate(prompts):
+            by_len.setdefault(len(p), []).append(i)
+        out = [None] * len(prompts)
+        for idx in by_len.values():
+            texts = self._decode_equal_length([prompts[i] for i in idx], max_new,
+                                              temperature, rng)
+            for i, text in zip(idx, texts):
+                out[i] = text
+        return out
+
+
+def exact_pass_rate(model, pairs=None):
+    """Exhaustive greedy pass-rate plus a (10, 10) bool grid, like r1_toy's."""
+    pairs = pairs or [(a, b) for a in range(10) for b in range(10)]
+    outs = model.generate_batch([f'{a}+{b}=' for a, b in pairs])
+    grid = np.zeros((10, 10), dtype=bool)
+    for o, (a, b) in zip(outs, pairs):
+        grid[a, b] = extract_answer(o) == a + b
+    return grid.mean(), grid
+
+
+# --------------------------------------------------------------------------
+# Worker processes: each one imports only NumPy (spawn start method)
+# --------------------------------------------------------------------------
+_WORKER_MODEL = None
+
+
+def _init_worker(path):
+    global _WORKER_MODEL
+    _WORKER_MODEL = NumpyTinyLM(path)
+
+
+def _score(pairs):
+    outs = _WORKER_MODEL.generate_batch([f'{a}+{b}=' for a, b in pairs])
+    return [extract_answer(o) == a + b for o, (a, b) in zip(outs, pairs)]
+
+
+def parallel_pass_rate(path, workers=4):
+    """`exact_pass_rate`, with the 100 prompts sharded over torch-free workers."""
+    pairs = [(a, b) for a in range(10) for b in range(10)]
+    shards = [pairs[i::workers] for i in range(workers)]
+    with mp.get_context('spawn').Pool(workers, _init_worker, (path,)) as pool:
+        results = pool.map(_score, shards)
+    grid = np.zeros((10, 10), dtype=bool)
+    for shard, res in zip(shards, results):
+        for (a, b), ok in zip(shard, res):
+            grid[a, b] = ok
+    return grid.mean(), grid
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Torch-free TinyLM pass-rate.')
+    ap.add_argument('weights', help='.npz written by r1_toy.export_numpy')
+    ap.add_argument('--workers', type=int, default=1)
+    args = ap.parse_args()
+    if args.workers > 1:
+        rate, _ = parallel_pass_rate(args.weights, args.workers)
+    else:
+        rate, _ = exact_pass_rate(NumpyTinyLM(args.weights))
+    print(f'pass-rate: {rate:.0%}')
@@ -0,0 +1,311 @@
+"""
+r1_parallel.py — multi-process GRPO for the R1 toy notebooks.
+
+`GRPOTrainer` samples and learns in one process, so one core does all the
+work. Here the two halves are split across processes:
+
+  * ACTORS  — N sampler processes. Each one reads the policy from a copy of
+              `TinyLM` kept in shared memory, samples P prompts x G
+              completions with no grad, scores them with `reward_ids`, and
+              puts the rollout on a queue, tagged with the weight version it
+              was sampled from.
+  * LEARNER — the calling process. It takes rollouts off the queue, re-scores
+              them with one teacher-forced pass (`sequence_logprobs`), applies
+              the usual group-relative update, and republishes its weights to
+              shared memory every `sync_every` steps.
+
+Actors keep sampling while the learner trains, so a rollout can come from
+weights a few updates old. That gap is the *policy lag*, logged on every
+step.
+
+    import r1_parallel as RP
+    trainer = RP.ActorLearnerGRPO(model, opt, actors=4, sync_every=2)
+    stats = trainer.run(steps=100)
+
+The second half of the file is plain synchronous data parallelism for the
+SFT-style stages and GRPO: `train_distributed` runs the same loop on N local
+processes (`torch.distributed`, gloo backend, CPU only), each on 1/N of the
+batch, with gradients all-reduced before every optimizer step.
+
+    stats = RP.train_distributed(model, 'sft', world=4, strings=sft_data, steps=400)
+"""
+
+import os
+import copy
+import time
+import queue
+import random
+import socket
+import tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import r1_toy as R
+
+
+# --------------------------------------------------------------------------
+# Actor: sample from the shared weights, push rollouts
+# --------------------------------------------------------------------------
+def _actor(rank, shared, version, lock, out, stop, cfg):
+    torch.set_num_threads(1)
+    torch.manual_seed(cfg['seed'] + rank)
+    random.seed(cfg['seed'] + rank)
+    local, seen = copy.deepcopy(shared), -1
+    # the learner's own rollout path, without an optimizer: sample under
+    # no_grad (rescore=True), leave the scoring pass to the learner
+    t = R.GRPOTrainer(local, None, cfg['P'], cfg['G'], cfg['max_new'], cfg['temperature'],
+                      cfg['constrained'], rescore=True)
+    while not stop.is_set():
+        if version.value != seen:
+            with lock:
+                local.load_state_dict(shared.state_dict())
+                seen = version.value
+        prompts = [R.random_prompt()[0] for _ in range(cfg['P'])]
+        seqs, valid, gen_mask, _ = t.rollout(prompts, score=False)
+        r = t.rewards(prompts, seqs, gen_mask)
+        item = (seqs, valid, gen_mask, r, seen, rank)
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+
+# --------------------------------------------------------------------------
+# Learner
+# --------------------------------------------------------------------------
+class ActorLearnerGRPO:
+    """
+    GRPO with `actors` sampler processes feeding one learner (this process).
+
+    The learner owns `model` and `opt` and runs the update through a
+    `GRPOTrainer`, so the loss is the same as the single-process one. Rollout
+    weights are published every `sync_every` learner steps. The queue holds
+    at most `max_queue` rollouts (default 2 per actor), so actors cannot get
+    far ahead of the learner.
+
+    `history` keeps one stats dict per step: loss, mean reward, policy lag
+    (learner steps since the rollout's weights were published), the actor
+    that produced it, and the wall time.
+    """
+
+    def __init__(self, model, opt, actors=2, sync_every=1, P=8, G=4, max_new=16,
+                 temperature=1.0, constrained=False, max_queue=None, seed=0):
+        self.model = model
+        self.trainer = R.GRPOTrainer(model, opt, P, G, max_new, temperature, constrained,
+                                     rescore=True)
+        self.actors, self.sync_every = actors, sync_every
+        self.max_queue = max_queue or 2 * actors
+        self.cfg = dict(P=P, G=G, max_new=max_new, temperature=temperature,
+                        constrained=constrained, seed=seed)
+        self.history = []
+        self.steps = 0
+
+    def _publish(self, shared, version, lock):
+        with lock, torch.no_grad():
+            for dst, src in zip(shared.state_dict().values(), self.model.state_dict().values()):
+                dst.copy_(src)
+            version.value = self.steps
+
+    def run(self, steps=100):
+        """
+        Start the actors, take `steps` learner updates, shut the actors down.
+        Returns totals: rollouts/s and generated tokens/s (timed from the
+        first rollout, so process start-up is excluded), mean and max policy
+        lag, and the share of steps spent waiting on the queue.
+        """
+        if steps < 1:
+            raise ValueError(f'steps must be at least 1, got {steps}')
+        ctx = mp.get_context('spawn')
+        shared = copy.deepcopy(self.model).share_memory()
+        version, lock = ctx.Value('i', self.steps, lock=False), ctx.Lock()
+        out, stop = ctx.Queue(self.max_queue), ctx.Event()
+        procs = [ctx.Process(target=_actor, args=(i, shared, version, lock, out, stop, self.cfg),
+                             daemon=True) for i in range(self.actors)]
+        for p in procs:
+            p.start()
+        t = self.trainer
+        rollouts = tokens = 0
+        wait = 0.0
+        try:
+            t0 = None
+            for _ in range(steps):
+                tw = time.perf_counter()
+                seqs, valid, gen_mask, r, v, rank = out.get()
+                if t0 is None:
+                    t0 = time.perf_counter()
+                else:
+                    wait += time.perf_counter() - tw
+                logps = R.sequence_logprobs(self.model, seqs, valid, gen_mask,
+                                            t.temperature, t.constrained)
+                loss = t.update(logps, r)
+                self.steps += 1
+                if self.steps % self.sync_every == 0:
+                    self._publish(shared, version, lock)
+                rollouts += r.numel()
+                tokens += gen_mask.sum().item()
+                self.history.append({
+                    'loss': loss.item(),
+                    'mean_reward': r.mean().item(),
+                    'policy_lag': self.steps - 1 - v,
+                    'actor': rank,
+                    'time': time.perf_counter() - t0,
+                })
+            dt = time.perf_counter() - t0
+        finally:
+            stop.set()
+            while any(p.is_alive() for p in procs):
+                try:
+                    out.get(timeout=0.1)
+                except (queue.Empty, OSError, RuntimeError):
+                    pass  # empty, or a tensor whose sender already exited
+            for p in procs:
+                p.join()
+        lags = [h['policy_lag'] for h in self.history[-steps:]]
+        return {
+            'actors': self.actors,
+            'rollouts_per_s': rollouts / dt,
+            'tokens_per_s': tokens / dt,
+            'mean_policy_lag': sum(lags) / len(lags),
+            'max_policy_lag': max(lags),
+            'learner_wait_frac': wait / dt,
+        }
+
+
+def actor_benchmark(model, actors=(1, 2, 4), steps=30, sync_every=1, P=8, G=4, lr=1e-4):
+    """
+    Rollouts/s and policy lag as the number of actors grows. Each setting
+    trains its own copy of `model`; the single-process `GRPOTrainer`
+    (rescore=True, same P and G) is the 'serial' baseline.
+    """
+    m = copy.deepcopy(model)
+    serial = R.GRPOTrainer(m, torch.optim.AdamW(m.parameters(), lr=lr), P, G, rescore=True)
+    serial.step()
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        serial.step()
+    out = {'serial': {'rollouts_per_s': steps * P * G / (time.perf_counter() - t0)}}
+    for n in actors:
+        m = copy.deepcopy(model)
+        al = ActorLearnerGRPO(m, torch.optim.AdamW(m.parameters(), lr=lr), n, sync_every, P, G)
+        out[n] = al.run(steps)
+    return out
+
+
+# --------------------------------------------------------------------------
+# Data-parallel training: N ranks, gloo all-reduce, one optimizer step each
+# --------------------------------------------------------------------------
+class AllReduceOptimizer:
+    """
+    Wraps an optimizer so `step()` first averages every gradient across the
+    process group, in ONE all-reduce over a flattened buffer. Loops written
+    for a single process (including `GRPOTrainer.update`) run unchanged.
+    """
+
+    def __init__(self, opt, params):
+        self.opt, self.params = opt, [p for p in params if p.requires_grad]
+
+    def zero_grad(self):
+        self.opt.zero_grad()
+
+    def step(self):
+        grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in self.params]
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        dist.all_reduce(flat)
+        flat /= dist.get_world_size()
+        for p, g in zip(self.params, flat.split([g.numel() for g in grads])):
+            p.grad = g.view_as(p)
+        self.opt.step()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _dist_worker(rank, world, port, cfg, state, stage, kw, out_path):
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}',
+                            rank=rank, world_size=world)
+    seed = kw['seed'] * 1000 + rank
+    torch.manual_seed(seed)
+    random.seed(seed)
+    model = R.TinyLM(**cfg)
+    model.load_state_dict(state)
+    opt = AllReduceOptimizer(torch.optim.AdamW(model.parameters(), lr=kw['lr']),
+                             model.parameters())
+    losses = []
+    if stage == 'sft':
+        ds = R.SFTDataset(kw['strings'], seed=seed)
+        step = lambda: R.lm_loss(model, ds.batch(kw['batch'] // world))
+    else:
+        trainer = R.GRPOTrainer(model, opt, kw['P'] // world, kw['G'], kw['max_new'],
+                                kw['temperature'], kw['constrained'], kw['rescore'])
+    dist.barrier()
+    t0 = time.perf_counter()
+    for _ in range(kw['steps']):
+        if stage == 'sft':
+            loss = step()
+            opt.zero_grad(); loss.backward(); opt.step()
+            losses.append(loss.item())
+        else:
+            losses.append(trainer.step()['mean_reward'])
+    dist.barrier()
+    dt = time.perf_counter() - t0
+    if rank == 0:
+        torch.save({'state': model.state_dict(), 'time': dt, 'curve': losses}, out_path)
+    dist.destroy_process_group()
+
+
+def train_distributed(model, stage, world=2, steps=100, lr=None, seed=0, strings=None,
+                      batch=16, P=8, G=4, max_new=16, temperature=1.0, constrained=False,
+                      rescore=False):
+    """
+    Train `model` in place for `steps` synchronous data-parallel steps on
+    `world` local CPU processes.
+
+      stage='sft'   next-token loss on `strings` (cold-start or rejection
+                    SFT); each rank draws batch/world rows per step
+      stage='grpo'  `GRPOTrainer` steps; each rank samples P/world prompts
+                    x G completions
+
+    The global batch is the same for every `world`, so the run matches the
+    single-process loop up to sampling noise. Every rank is seeded with
+    seed*1000 + rank, so a run is reproducible for a fixed `world`. Returns
+    {'world', 'steps_per_s', 'curve'}: the per-step loss (sft) or mean
+    reward (grpo) seen by rank 0.
+    """
+    if stage not in ('sft', 'grpo'):
+        raise ValueError(f"stage must be 'sft' or 'grpo', not {stage!r}")
+    if stage == 'sft' and (strings is None or batch % world):
+        raise ValueError('sft needs `strings` and a batch divisible by world')
+    if stage == 'grpo' and P % world:
+        raise ValueError(f'P={P} must be divisible by world={world}')
+    kw = dict(steps=steps, lr=lr or (3e-3 if stage == 'sft' else 1e-4), seed=seed,
+              strings=strings, batch=batch, P=P, G=G, max_new=max_new,
+              temperature=temperature, constrained=constrained, rescore=rescore)
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, 'rank0.pt')
+        mp.spawn(_dist_worker, args=(world, _free_port(), model.config(), state, stage, kw,
+                                     out_path), nprocs=world)
+        result = torch.load(out_path)
+    model.load_state_dict(result['state'])
+    return {'world': world, 'steps_per_s': steps / result['time'], 'curve': result['curve']}
+
+
+def scaling_benchmark(model, stage='sft', ranks=(1, 2, 4), steps=100, **kwargs):
+    """
+    Steps/s from 1 to N ranks, plus the exhaustive pass-rate each run ends
+    at. Each setting trains its own copy of `model` from the same start.
+    """
+    out = {}
+    for n in ranks:
+        m = copy.deepcopy(model)
+        stats = train_distributed(m, stage, world=n, steps=steps, **kwargs)
+        out[n] = {'steps_per_s': stats['steps_per_s'],
+                  'speedup': stats['steps_per_s'] / out[ranks[0]]['steps_per_s'] if out else 1.0,
+                  'pass_rate': R.exact_pass_rate(m)[0]}
+    return out
@@ -0,0 +1,218 @@
+"""
+r1_pipeline.py — the whole five-stage R1 recipe, headless, with a JSON report.
+
+Notebooks 02-03 run the recipe cell by cell. This script runs the same
+stages back to back from one config, so you can benchmark it, run it in
+batch, and compare runs over time:
+
+    cold_start_sft -> grpo -> rejection_sampling -> rejection_sft -> distillation
+
+For every stage the report records wall time, tokens processed, memory and
+the exhaustive greedy pass-rate (`r1_toy.exact_pass_rate`, not counted in
+the stage time). Memory is the process's peak RSS, a high-water mark:
+`peak_rss_mb` is the peak so far (cumulative over earlier stages, and over
+earlier seeds run by the same pool worker), `rss_growth_mb` how much this
+stage raised it (0 when it stayed under an earlier peak).
+
+The defaults are the notebooks' settings. A config file only needs the
+keys it changes:
+
+    {"seeds": [0, 1, 2], "grpo": {"steps": 500}}
+
+    python r1_pipeline.py                                  # defaults, seed 0
+    python r1_pipeline.py config.json --out report.json --workers 3
+
+With several seeds, `--workers` runs them in parallel processes.
+"""
+
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import multiprocessing as mp
+import torch
+import r1_toy as R
+
+DEFAULTS = {
+    'seeds': [0],
+    'cold_start_sft': {'n_examples': 20, 'steps': 400, 'lr': 3e-3, 'batch': 16},
+    'grpo': {'P': 1, 'G': 4, 'steps': 300, 'lr': 1e-4},
+    'rejection_sampling': {'max_tries': 12, 'keep': 1},
+    'rejection_sft': {'steps': 300, 'lr': 1e-3, 'batch': 16},
+    'distillation': {'d': 32, 'L': 1, 'T': 2.0, 'steps': 600, 'lr': 3e-3, 'batch': 16},
+}
+
+
+def load_config(path=None):
+    """DEFAULTS, with each section updated from the JSON file at `path`."""
+    cfg = copy.deepcopy(DEFAULTS)
+    if path:
+        with open(path) as f:
+            user = json.load(f)
+        for k, v in user.items():
+            if k not in cfg:
+                raise ValueError(f'unknown config key {k!r}')
+            if isinstance(cfg[k], dict):
+                cfg[k].update(v)
+            else:
+                cfg[k] = v
+    return cfg
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+# --------------------------------------------------------------------------
+# Stages: each takes the running state dict and its config section, updates
+# the state, and returns (tokens processed, extra report fields)
+# --------------------------------------------------------------------------
+def _sft(model, ds, steps, lr, batch):
+    opt = torch.optim.AdamW(model.parameters(), lr=lr)
+    tokens = 0
+    for _ in range(steps):
+        x = ds.batch(batch)
+        loss = R.lm_loss(model, x)
+        opt.zero_grad(); loss.backward(); opt.step()
+        tokens += x.numel()
+    return tokens, {'final_loss': loss.item()}
+
+
+def cold_start_sft(st, cfg):
+    st['model'] = R.TinyLM()
+    exs = R.all_examples(); random.shuffle(exs)
+    ds = R.SFTDataset(exs[:cfg['n_examples']], seed=st['seed'])
+    return _sft(st['model'], ds, cfg['steps'], cfg['lr'], cfg['batch'])
+
+
+def grpo(st, cfg):
+    model = st['model']
+    # tied groups skip the optimizer step, like the notebooks' grpo_step
+    trainer = R.GRPOTrainer(model, torch.optim.AdamW(model.parameters(), lr=cfg['lr']),
+                            P=cfg['P'], G=cfg['G'], filter_groups=True)
+    for _ in range(cfg['steps']):
+        trainer.step()
+    tokens = sum(h['tokens'] for h in trainer.history)
+    rewards = [h['mean_reward'] for h in trainer.history]
+    return tokens, {'final_mean_reward': sum(rewards[-30:]) / len(rewards[-30:])}
+
+
+def rejection_sampling(st, cfg):
+    prompts = [f'{a}+{b}=' for a in range(10) for b in range(10)]
+    st['kept'], stats = R.rejection_sample(st['model'], prompts, cfg['max_tries'], cfg['keep'])
+    return stats['tokens'], {k: stats[k] for k in ('samples', 'kept', 'kept_rate')}
+
+
+def rejection_sft(st, cfg):
+    if not st['kept']:
+        raise RuntimeError('rejection sampling kept no examples')
+    ds = R.SFTDataset(st['kept'], seed=st['seed'])
+    return _sft(st['model'], ds, cfg['steps'], cfg['lr'], cfg['batch'])
+
+
+def distillation(st, cfg):
+    teacher = st['model']
+    student = R.TinyLM(d=cfg['d'], L=cfg['L'])
+    with R.eval_mode(teacher):
+        distill_set = R.generate_batch(teacher, [f'{a}+{b}=' for a in range(10)
+                                                 for b in range(10)])
+        ds = R.DistillDataset(teacher, distill_set, T=cfg['T'], seed=st['seed'])
+    opt = torch.optim.AdamW(student.parameters(), lr=cfg['lr'])
+    tokens = sum(len(s) for s in distill_set)   # the teacher's one scoring pass
+    for _ in range(cfg['steps']):
+        x, soft = ds.batch(cfg['batch'])
+        loss = R.distill_loss(student, x, soft, cfg['T'])
+        opt.zero_grad(); loss.backward(); opt.step()
+        tokens += x.numel()
+    st['model'] = student
+    return tokens, {'final_kl': loss.item(), 'student_params_K': R.n_params(student)}
+
+
+STAGES = [cold_start_sft, grpo, rejection_sampling, rejection_sft, distillation]
+
+
+# --------------------------------------------------------------------------
+# Runner
+# --------------------------------------------------------------------------
+def run_seed(cfg, seed, threads=None):
+    """Run all stages for one seed; returns that seed's report entry."""
+    if threads:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed); random.seed(seed)
+    st = {'seed': seed, 'model': None, 'kept': []}
+    stages, t_all = [], time.perf_counter()
+    rss = _peak_rss_mb()
+    for fn in STAGES:
+        t0 = time.perf_counter()
+        tokens, extra = fn(st, cfg[fn.__name__])
+        dt = time.perf_counter() - t0
+        rss, prev = _peak_rss_mb(), rss
+        stages.append(dict({
+            'stage': fn.__name__,
+            'seconds': dt,
+            'tokens': tokens,
+            'tokens_per_s': tokens / dt,
+            'peak_rss_mb': rss,
+            'rss_growth_mb': rss - prev,
+            'pass_rate': R.exact_pass_rate(st['model'])[0],
+        }, **extra))
+    return {'seed': seed, 'seconds': time.perf_counter() - t_all, 'stages': stages}
+
+
+def _summary(runs):
+    out = {}
+    for i, s in enumerate(runs[0]['stages']):
+        per = [r['stages'][i] for r in runs]
+        out[s['stage']] = {k: sum(p[k] for p in per) / len(per)
+                           for k in ('seconds', 'tokens_per_s', 'peak_rss_mb', 'rss_growth_mb',
+                                     'pass_rate')}
+    return out
+
+
+def run_pipeline(cfg, workers=1):
+    """
+    Run every seed in cfg['seeds'] (in a spawn process pool when workers > 1,
+    with the CPU threads split between them) and return the full report.
+    """
+    t0 = time.perf_counter()
+    if workers > 1:
+        threads = max(1, torch.get_num_threads() // workers)
+        with mp.get_context('spawn').Pool(workers) as pool:
+            runs = pool.starmap(run_seed, [(cfg, s, threads) for s in cfg['seeds']])
+    else:
+        runs = [run_seed(cfg, s) for s in cfg['seeds']]
+    return {
+        'config': cfg,
+        'env': {'python': platform.python_version(), 'torch': torch.__version__,
+                'machine': platform.machine(), 'workers': workers},
+        'seconds': time.perf_counter() - t0,
+        'runs': runs,
+        'summary': _summary(runs),
+    }
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Run the five-stage R1 recipe headless.')
+    ap.add_argument('config', nargs='?', help='JSON overrides for DEFAULTS')
+    ap.add_argument('--out', default='r1_pipeline_report.json')
+    ap.add_argument('--seeds', type=int, nargs='+', help='overrides the config seeds')
+    ap.add_argument('--workers', type=int, default=1)
+    args = ap.parse_args()
+    cfg = load_config(args.config)
+    if args.seeds:
+        cfg['seeds'] = args.seeds
+    report = run_pipeline(cfg, args.workers)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'{"stage":<20}{"seconds":>9}{"tok/s":>10}{"peak RSS":>10}{"+RSS":>7}{"pass-rate":>11}')
+    for name, s in report['summary'].items():
+        print(f'{name:<20}{s["seconds"]:>9.1f}{s["tokens_per_s"]:>10.0f}'
+              f'{s["peak_rss_mb"]:>10.0f}{s["rss_growth_mb"]:>7.0f}{s["pass_rate"]:>11.0%}')
+    print('RSS in MB: peak is cumulative (process high-water mark), + is this stage\'s growth')
+    print(f'wrote {args.out}')
@@ -33,8 +33,16 @@ So `T`/`A` are just terse aliases for `<think>`/`<answer>` — same idea, smalle
 alphabet, RL-friendly. This is a deliberate, documented simplification.
 """
 
+import os
 import re
+import json
+import time
 import random
+from collections import Counter
+import hashlib
+import copy
+from contextlib import contextmanager
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -87,6 +95,94 @@ def pad_batch(strings):
     return torch.tensor([x + [PAD] * (L - len(x)) for x in ids])
 
 
+class SFTDataset:
+    """
+    A fixed SFT corpus encoded ONCE: `data` is an (N, L) right-padded
+    LongTensor, `lengths` the true length of each row. `batch(k)` draws k
+    rows with replacement by tensor indexing (seeded generator) and trims
+    them to the longest one -- the same batch `pad_batch(random.choices(...))`
+    builds, without re-encoding strings every step.
+    """
+
+    def __init__(self, strings, seed=0):
+        self.data = pad_batch(strings)
+        self.lengths = torch.tensor([len(s) for s in strings])
+        self.gen = torch.Generator().manual_seed(seed)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def batch(self, k=16):
+        idx = torch.randint(len(self), (k,), generator=self.gen)
+        return self.data[idx, :int(self.lengths[idx].max())]
+
+
+class PackedSFTDataset:
+    """
+    Sequence packing: whole examples laid back to back into rows of exactly
+    BLOCK+1 tokens (so inputs are BLOCK long), instead of one example per
+    row padded to the longest. `doc` numbers the examples inside each row;
+    `TinyLM.forward(x, doc_ids)` restarts positions and blocks attention at
+    every boundary, so each example is trained as if it were alone.
+    Rows are packed once, best-fit decreasing, from about `n_rows` worth of
+    shuffled passes over the corpus; `batch(k)` then just indexes them.
+    """
+
+    def __init__(self, strings, n_rows=512, seed=0):
+        self.gen = torch.Generator().manual_seed(seed)
+        L = BLOCK + 1
+        docs = [encode(s) for s in strings]
+        if max(len(d) for d in docs) > L:
+            raise ValueError(f'an example is longer than a packed row ({L} tokens)')
+        pool, n_tok = [], 0
+        while n_tok < n_rows * L:
+            for i in torch.randperm(len(docs), generator=self.gen).tolist():
+                pool.append(docs[i]); n_tok += len(docs[i])
+                if n_tok >= n_rows * L:
+                    break
+        # best fit decreasing: longest example first, each into the row with
+        # the least room that still holds it (a 12 and a 13 fill a row of 25)
+        rows, free = [], [[] for _ in range(L + 1)]   # free[r]: rows with r slots left
+        for d in sorted(pool, key=len, reverse=True):
+            r = next((r for r in range(len(d), L + 1) if free[r]), None)
+            if r is None:
+                rows.append([]); j = len(rows) - 1
+            else:
+                j = free[r].pop()
+            rows[j].append(d)
+            free[L - sum(map(len, rows[j]))].append(j)
+        data, ids = [], []
+        for row in rows:
+            doc = [i for i, d in enumerate(row) for _ in d]
+            data.append([t for d in row for t in d] + [PAD] * (L - len(doc)))
+            ids.append(doc + [len(row)] * (L - len(doc)))   # filler
+        self.data, self.doc = torch.tensor(data), torch.tensor(ids)
+
+    def __len__(self):
+        return len(self.data)
+
+    def batch(self, k=16):
+        """k packed rows: (x, doc_ids), both (k, BLOCK+1)."""
+        idx = torch.randint(len(self), (k,), generator=self.gen)
+        return self.data[idx], self.doc[idx]
+
+
+def lm_targets(x, doc_ids=None):
+    """Next-token targets for `x`; PAD (ignored) where a packed example ends."""
+    y = x[:, 1:]
+    if doc_ids is not None:
+        y = y.masked_fill(doc_ids[:, 1:] != doc_ids[:, :-1], PAD)
+    return y
+
+
+def lm_loss(model, x, doc_ids=None):
+    """Next-token cross-entropy on a batch; pass doc_ids for packed rows."""
+    d = None if doc_ids is None else doc_ids[:, :-1]
+    logits = model(x[:, :-1], d)
+    return F.cross_entropy(logits.reshape(-1, V), lm_targets(x, doc_ids).reshape(-1),
+                           ignore_index=PAD)
+
+
 # --------------------------------------------------------------------------
 # Model: a tiny char-level transformer LM
 # --------------------------------------------------------------------------
@@ -104,37 +200,395 @@ class TinyLM(nn.Module):
         ])
         self.head = nn.Linear(d, V)
         self.block = block
+        # built once instead of on every forward; non-persistent, so they
+        # never show up in (or break loading of) saved state_dicts
+        self.register_buffer('positions', torch.arange(block), persistent=False)
+        self.register_buffer('causal_mask',
+                             nn.Transformer.generate_square_subsequent_mask(block),
+                             persistent=False)
 
-    def forward(self, x):
+    def config(self):
+        """Constructor kwargs that rebuild this architecture."""
+        return {'V': self.tok.num_embeddings, 'd': self.tok.embedding_dim,
+                'h': self.blocks[0].self_attn.num_heads, 'L': len(self.blocks),
+                'block': self.block}
+
+    def forward(self, x, doc_ids=None):
+        """
+        Logits for every position of `x` (B, T). For packed rows, `doc_ids`
+        (B, T) says which example each token belongs to: positions restart
+        at 0 and attention stays inside each example.
+        """
         T = x.shape[1]
-        h = self.tok(x) + self.pos(torch.arange(T, device=x.device))
-        mask = nn.Transformer.generate_square_subsequent_mask(T).to(x.device)
+        if doc_ids is None:
+            h = self.tok(x) + self.pos(self.positions[:T])
+            mask = self.causal_mask[:T, :T]
+        else:
+            h = self.tok(x) + self.pos(_doc_positions(doc_ids))
+            mask = _doc_mask(doc_ids, self.blocks[0].self_attn.num_heads)
         for blk in self.blocks:
             h = blk(h, src_mask=mask)
         return self.head(h)
 
+    def forward_cached(self, x, cache, valid=None, block_fn=None):
+        """
+        Incremental forward for decoding: run only the NEW tokens `x` (B, T)
+        against the keys/values already in `cache`, append theirs, and return
+        logits for the new positions. Same weights and math as `forward`.
+
+        `valid` (B, T) marks real tokens; False slots (left padding, or rows
+        that already finished) are never attended to and do not advance the
+        position counter, so a padded row decodes exactly like it would alone.
+        `block_fn` swaps in another implementation of `_cached_block` (e.g. a
+        compiled one, see `FusedTinyLM`).
+        """
+        block_fn = block_fn or _cached_block
+        P, T = len(cache), x.shape[1]
+        if valid is None:
+            valid = torch.ones_like(x, dtype=torch.bool)
+        seen = cache.valid.sum(1, keepdim=True) if P else 0
+        pos = (seen + valid.cumsum(1) - 1).clamp(min=0)
+        cache.valid = torch.cat([cache.valid, valid], 1) if P else valid
+        h = self.tok(x) + self.pos(pos)
+        # one new real token may see everything cached and an unpadded
+        # prefill is plain causal attention; otherwise mask out the future
+        # and the padding (each slot always sees itself, so a pad query
+        # never ends up with an empty softmax)
+        mask, is_causal = None, False
+        if P == 0 and cache.valid.all():
+            is_causal = T > 1
+        elif T > 1 or not cache.valid.all():
+            causal = torch.ones(T, P + T, dtype=torch.bool, device=x.device).tril(P)
+            idx = torch.arange(P + T, device=x.device)
+            self_ = idx == idx[P:, None]
+            mask = (causal & (cache.valid[:, None, :] | self_)).unsqueeze(1)
+        layers = []
+        for i, blk in enumerate(self.blocks):
+            h, kv = block_fn(blk, h, cache.layers[i] if P else None, mask, is_causal)
+            layers.append(kv)
+        cache.layers = layers
+        return self.head(h)
+
+
+def _doc_positions(doc_ids):
+    """Position of each token within its own example: 0 at every boundary."""
+    T = doc_ids.shape[1]
+    idx = torch.arange(T, device=doc_ids.device).expand_as(doc_ids)
+    starts = torch.ones_like(doc_ids, dtype=torch.bool)
+    starts[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+    return idx - (idx * starts).cummax(1).values
+
+
+def _doc_mask(doc_ids, heads):
+    """Causal AND same-example additive mask, (B*heads, T, T) as nn.MultiheadAttention wants."""
+    T = doc_ids.shape[1]
+    causal = torch.ones(T, T, dtype=torch.bool, device=doc_ids.device).tril()
+    allowed = causal & (doc_ids[:, :, None] == doc_ids[:, None, :])
+    mask = torch.zeros(allowed.shape, device=doc_ids.device).masked_fill(~allowed, float('-inf'))
+    return mask.repeat_interleave(heads, 0)
+
+
+class KVCache:
+    """Per-layer (key, value) tensors, each (B, heads, S, d/heads), plus the
+    (B, S) mask of which cached slots are real tokens."""
+
+    def __init__(self):
+        self.layers = []
+        self.valid = None
+
+    def __len__(self):
+        return self.layers[0][0].shape[2] if self.layers else 0
+
+    def truncate(self, n):
+        """Forget everything after the first n cached positions."""
+        self.layers = [(k[:, :, :n], v[:, :, :n]) for k, v in self.layers]
+        if self.valid is not None:
+            self.valid = self.valid[:, :n]
+
+
+def _cached_block(blk, h, past, mask, is_causal=False):
+    """One post-norm `nn.TransformerEncoderLayer`, re-done by hand with a KV cache."""
+    attn = blk.self_attn
+    B, T, d = h.shape
+    nh = attn.num_heads
+    q, k, v = F.linear(h, attn.in_proj_weight, attn.in_proj_bias).chunk(3, -1)
+    q, k, v = (t.view(B, T, nh, d // nh).transpose(1, 2) for t in (q, k, v))
+    if past is not None:
+        k, v = torch.cat([past[0], k], 2), torch.cat([past[1], v], 2)
+    a = F.scaled_dot_product_attention(
+        q, k, v, attn_mask=mask, dropout_p=attn.dropout if blk.training else 0.0,
+        is_causal=is_causal)
+    a = attn.out_proj(a.transpose(1, 2).reshape(B, T, d))
+    h = blk.norm1(h + blk.dropout1(a))
+    ff = blk.linear2(blk.dropout(blk.activation(blk.linear1(h))))
+    h = blk.norm2(h + blk.dropout2(ff))
+    return h, (k, v)
+
+
+class QuantizedTinyLM(TinyLM):
+    """
+    Inference-only TinyLM whose block feed-forward Linears and `head` run as
+    dynamic int8 (`torch.ao.quantization.quantize_dynamic`); build it with
+    `load_quantized`. The attention projections stay fp32 (`in_proj` is a
+    bare parameter and `out_proj` is excluded by PyTorch). Every forward
+    goes through the hand-written block, because the fused fast path of
+    `nn.TransformerEncoderLayer` cannot read quantized weights.
+    """
+
+    def forward(self, x, doc_ids=None):
+        if doc_ids is not None:
+            raise ValueError('packed (doc_ids) batches are training-only')
+        return self.forward_cached(x, KVCache())
+
+
+def load_quantized(state_dict, **kwargs):
+    """
+    A `QuantizedTinyLM` from a saved fp32 state_dict (or a path to one, e.g.
+    a `CheckpointStore` entry 'checkpoints/<key>.pt'). Pass the TinyLM kwargs
+    for non-default shapes, e.g. d=32, L=1 for the distilled student.
+    """
+    if isinstance(state_dict, str):
+        state_dict = torch.load(state_dict)
+    model = QuantizedTinyLM(**kwargs)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8,
+                                                  inplace=True)
+
+
+def _fused_forward(lm, x, block_fn=None):
+    """Full-sequence TinyLM forward through the hand-written block: cached
+    position buffer, SDPA with is_causal=True, no mask tensor at all."""
+    block_fn = block_fn or _cached_block
+    h = lm.tok(x) + lm.pos(lm.positions[:x.shape[1]])
+    for blk in lm.blocks:
+        h, _ = block_fn(blk, h, None, None, True)
+    return lm.head(h)
+
+
+class _TraceableForward(nn.Module):
+    def __init__(self, lm):
+        super().__init__()
+        self.lm = lm
+
+    def forward(self, x):
+        return _fused_forward(self.lm, x)
+
+
+class FusedTinyLM(nn.Module):
+    """
+    Optimized inference backend: an eval-mode snapshot of a trained TinyLM
+    that is a drop-in for `generate`, `sample_*`, `pass_rate` and friends.
+      mode='sdpa'     eager, fused `scaled_dot_product_attention`
+      mode='compile'  the block function wrapped in `torch.compile`
+      mode='script'   full-sequence forward traced and `torch.jit.freeze`d,
+                      one frozen graph per input shape (built lazily)
+    Decoding (`generate`, `sample_*`, `pass_rate`, `generate_batch`) always
+    goes through the KV cache (`forward_cached`), which the frozen graph
+    does not cover: there mode='script' runs exactly what mode='sdpa' runs,
+    and only `forward()` on whole sequences uses the TorchScript graph.
+    """
+
+    def __init__(self, model, mode='sdpa'):
+        super().__init__()
+        if mode not in ('sdpa', 'compile', 'script'):
+            raise ValueError(f'unknown mode {mode!r}')
+        self.lm = copy.deepcopy(model).eval()
+        self.block, self.mode = model.block, mode
+        self._block_fn = _cached_block
+        if mode == 'compile':
+            self._block_fn = torch.compile(_cached_block, dynamic=True)
+        self._frozen = {}
+
+    def config(self):
+        return self.lm.config()
+
+    def forward(self, x, doc_ids=None):
+        if doc_ids is not None:
+            raise ValueError('packed (doc_ids) batches are training-only')
+        if self.mode != 'script':
+            return _fused_forward(self.lm, x, self._block_fn)
+        key = tuple(x.shape)
+        if key not in self._frozen:
+            with torch.no_grad():
+                traced = torch.jit.trace(_TraceableForward(self.lm).eval(), x)
+            self._frozen[key] = torch.jit.freeze(traced)
+        return self._frozen[key](x)
+
+    def forward_cached(self, x, cache, valid=None):
+        return self.lm.forward_cached(x, cache, valid, self._block_fn)
+
+
+def export_numpy(model, path):
+    """Save weights + architecture + vocab to an .npz for torch-free `r1_numpy`."""
+    cfg = {**model.config(), 'eps': model.blocks[0].norm1.eps}
+    arrays = {k: t.detach().cpu().numpy() for k, t in model.state_dict().items()}
+    np.savez(path, __config__=np.array(json.dumps(cfg)), __vocab__=np.array(''.join(VOCAB)),
+             **arrays)
+
 
 def n_params(model):
     """Parameter count in thousands."""
     return sum(p.numel() for p in model.parameters()) / 1e3
 
 
+# --------------------------------------------------------------------------
+# Format grammar for constrained decoding
+#   Every completion should look like  T{d}+{d} A{d}[{d}].  -- a regular
+#   language, so a 10-state automaton can say which tokens are legal next.
+#   FSA_NEXT[state, token] is the next state (-1 = illegal); the last state
+#   ("done", after '.') allows anything since the row has already finished.
+# --------------------------------------------------------------------------
+def _format_fsa():
+    digits = '0123456789'
+    spec = [
+        {'T': 1},
+        {d: 2 for d in digits},
+        {'+': 3},
+        {d: 4 for d in digits},
+        {' ': 5},
+        {'A': 6},
+        {d: 7 for d in digits},
+        {**{d: 8 for d in digits}, '.': 9},   # one- or two-digit answer
+        {'.': 9},
+    ]
+    nxt = torch.full((len(spec) + 1, V), -1, dtype=torch.long)
+    for state, edges in enumerate(spec):
+        for c, to in edges.items():
+            nxt[state, STOI[c]] = to
+    nxt[len(spec)] = len(spec)
+    return nxt
+
+
+FSA_NEXT = _format_fsa()
+FSA_ALLOWED = FSA_NEXT >= 0
+
+
+def _constrain(logits, state):
+    """Mask logits (B, V) to the tokens the format allows in each row's state."""
+    return logits.masked_fill(~FSA_ALLOWED[state], float('-inf'))
+
+
 # --------------------------------------------------------------------------
 # Generation
+#   Decoding goes through a KV cache: each step feeds only the newest token
+#   instead of re-running the whole prefix. `use_cache=False` keeps the
+#   original full-recompute path around as the reference. `constrained=True`
+#   restricts every step to tokens the format grammar allows.
 # --------------------------------------------------------------------------
+def _step_logits(model, x, cache, valid=None):
+    """Next-token logits for the last position of `x` (B, S)."""
+    if cache is None:                      # reference: recompute the window
+        return model(x[:, -BLOCK:])[:, -1, :]
+    if valid is None:
+        valid = torch.ones_like(x, dtype=torch.bool)
+    if len(cache) and x.shape[1] <= BLOCK:  # cache holds x[:, :-1]
+        return model.forward_cached(x[:, -1:], cache, valid[:, -1:])[:, -1, :]
+    cache.layers = []                      # first step, or the window slid
+    return model.forward_cached(x[:, -BLOCK:], cache, valid[:, -BLOCK:])[:, -1, :]
+
+
+@contextmanager
+def eval_mode(model):
+    """Temporarily switch off dropout; restores the previous mode on exit."""
+    was_training = model.training
+    model.eval()
+    try:
+        yield model
+    finally:
+        model.train(was_training)
+
+
 @torch.no_grad()
-def generate(model, prompt, max_new=16):
+def generate(model, prompt, max_new=16, use_cache=True, constrained=False):
     """Greedy decode from a prompt; stops at EOS ('.')."""
     x = torch.tensor([encode(prompt)])
+    cache = KVCache() if use_cache else None
+    state = torch.zeros(1, dtype=torch.long)
     for _ in range(max_new):
-        logits = model(x[:, -BLOCK:])[:, -1, :]
+        logits = _step_logits(model, x, cache)
+        if constrained:
+            logits = _constrain(logits, state)
         nxt = torch.argmax(logits, -1, keepdim=True)
+        if constrained:
+            state = FSA_NEXT[state, nxt[:, 0]]
         x = torch.cat([x, nxt], 1)
         if nxt.item() == EOS:
             break
     return decode(x[0].tolist())
 
 
+# --------------------------------------------------------------------------
+# Batched generation: many prompts, one decode loop
+#   Prompts are LEFT-padded so every row's next token sits in the last
+#   column. A per-row `valid` mask tells the model which slots are padding,
+#   and a `done` mask retires rows once they emit EOS.
+# --------------------------------------------------------------------------
+def left_pad(prompts):
+    """Encode + left-pad prompts into (B, P) ids plus a (B, P) real-token mask.
+    (PAD is also the scratchpad's space, so the mask, not the id, says which
+    slots are padding.)"""
+    ids = [encode(p) for p in prompts]
+    L = max(len(t) for t in ids)
+    x = torch.tensor([[PAD] * (L - len(t)) + t for t in ids])
+    valid = torch.tensor([[False] * (L - len(t)) + [True] * len(t) for t in ids])
+    return x, valid
+
+
+def _decode_batch(model, x, valid, max_new=16, temperature=1.0, greedy=True,
+                  constrained=False):
+    """
+    Extend every row of left-padded `x` by up to `max_new` tokens in one loop.
+    Returns (x, valid, logp): slots after a row's EOS hold PAD and are not
+    valid; logp (B,) sums the log-probs of each row's generated tokens.
+    Stops as soon as every row has finished.
+    """
+    cache = KVCache()
+    done = torch.zeros(x.shape[0], dtype=torch.bool)
+    logp = torch.zeros(x.shape[0])
+    state = torch.zeros(x.shape[0], dtype=torch.long)
+    for _ in range(max_new):
+        logits = _step_logits(model, x, cache, valid) / temperature
+        if constrained:
+            logits = _constrain(logits, state)
+        if greedy:
+            nxt = logits.argmax(-1)
+        else:
+            nxt = torch.multinomial(F.softmax(logits, -1), 1).squeeze(1)
+        nxt = nxt.masked_fill(done, PAD)
+        lp = F.log_softmax(logits, -1).gather(1, nxt[:, None]).squeeze(1)
+        logp = logp + lp.masked_fill(done, 0.0)
+        if constrained:
+            state = FSA_NEXT[state, nxt]
+        x = torch.cat([x, nxt[:, None]], 1)
+        valid = torch.cat([valid, ~done[:, None]], 1)
+        done = done | (nxt == EOS)
+        if done.all():
+            break
+    return x, valid, logp
+
+
+def _decode_rows(x, valid):
+    return [decode(row[keep].tolist()) for row, keep in zip(x, valid)]
+
+
+@torch.no_grad()
+def generate_batch(model, prompts, max_new=16, constrained=False):
+    """Greedy-decode a list of prompts together; same strings as `generate`."""
+    x, valid = left_pad(prompts)
+    x, valid, _ = _decode_batch(model, x, valid, max_new, constrained=constrained)
+    return _decode_rows(x, valid)
+
+
+@torch.no_grad()
+def sample_batch(model, prompts, max_new=16, temperature=1.0, constrained=False):
+    """Sample one completion per prompt, all rows together (no grad)."""
+    x, valid = left_pad(prompts)
+    x, valid, _ = _decode_batch(model, x, valid, max_new, temperature, greedy=False,
+                                constrained=constrained)
+    return _decode_rows(x, valid)
+
+
 def extract_answer(text):
     """Pull the integer inside the 'A...' answer marker, or None."""
     m = re.search(r'A(\d+)\.', text)
@@ -146,15 +600,64 @@ def extract_answer(text):
 # --------------------------------------------------------------------------
 def pass_rate(model, n=200):
     """Fraction of n random a+b prompts the model answers correctly (greedy)."""
-    correct = 0
-    for _ in range(n):
-        a, b = random.randint(0, 9), random.randint(0, 9)
-        out = generate(model, f'{a}+{b}=')
-        if extract_answer(out) == a + b:
-            correct += 1
+    pairs = [(random.randint(0, 9), random.randint(0, 9)) for _ in range(n)]
+    outs = generate_batch(model, [f'{a}+{b}=' for a, b in pairs])
+    correct = sum(extract_answer(out) == a + b for out, (a, b) in zip(outs, pairs))
     return correct / n
 
 
+# The task only has 100 prompts, so instead of sampling we can score every
+# one of them in a single batched greedy decode. Dropout is switched off, so
+# the result is exact and deterministic and can be memoized per checkpoint.
+_EVAL_CACHE = {}
+
+
+def _hash_update(h, obj):
+    """Feed a state_dict value into a hash: tensors (incl. quantized), the
+    tuples quantized Linears pack their weights in, or anything with a repr."""
+    if isinstance(obj, torch.Tensor):
+        t = obj.detach().cpu()
+        if t.is_quantized:
+            if t.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+                _hash_update(h, (t.q_per_channel_scales(), t.q_per_channel_zero_points()))
+            else:
+                h.update(repr((t.q_scale(), t.q_zero_point())).encode())
+            t = t.int_repr()
+        h.update(f'{tuple(t.shape)}'.encode())
+        h.update(t.contiguous().numpy().tobytes())
+    elif isinstance(obj, (tuple, list)):
+        for o in obj:
+            _hash_update(h, o)
+    else:
+        h.update(repr(obj).encode())
+
+
+def model_hash(model):
+    """sha1 over a model's state_dict (names, shapes and raw weight bytes)."""
+    h = hashlib.sha1()
+    for name, t in model.state_dict().items():
+        h.update(name.encode())
+        _hash_update(h, t)
+    return h.hexdigest()
+
+
+def exact_pass_rate(model):
+    """
+    Exhaustive pass-rate over all 100 a+b prompts, plus a (10, 10) bool grid
+    where grid[a, b] says whether a+b= was answered correctly. Repeated calls
+    on unchanged weights are served from a cache.
+    """
+    key = model_hash(model)
+    if key not in _EVAL_CACHE:
+        pairs = [(a, b) for a in range(10) for b in range(10)]
+        with eval_mode(model):
+            outs = generate_batch(model, [f'{a}+{b}=' for a, b in pairs])
+        grid = torch.tensor([extract_answer(o) == a + b for o, (a, b) in zip(outs, pairs)])
+        _EVAL_CACHE[key] = grid.view(10, 10)
+    grid = _EVAL_CACHE[key]
+    return grid.float().mean().item(), grid.clone()
+
+
 # --------------------------------------------------------------------------
 # Reward (rule-based, R1 style): format credit + correctness credit
 # --------------------------------------------------------------------------
@@ -174,36 +677,891 @@ def reward(prompt, completion):
     return r
 
 
+def prompt_target(prompt):
+    """The true sum for a bare 'a+b=' prompt, or -1 if it is not one."""
+    m = re.match(r'(\d)\+(\d)=', prompt)
+    return int(m.group(1)) + int(m.group(2)) if m else -1
+
+
+def reward_ids(seqs, gen_mask, target):
+    """
+    `reward` for a whole batch of sampled token ids, with no string work.
+    seqs/gen_mask are (B, L) as returned by `sample_group`, target (B,) holds
+    each row's a+b (-1 for a malformed prompt -> 0 reward). Prompts are bare
+    'a+b=' strings, so any 'A<digits>.' match lies in the completion.
+
+    The 'A<digits>.' search is one right-to-left sweep over the columns that
+    tracks the digit run starting just after each position (its length, its
+    value saturated at 100, and whether a '.' follows it); the leftmost 'A'
+    whose run qualifies gives the answer. Matches `reward` exactly.
+    """
+    tok = seqs.masked_fill(~gen_mask, PAD)   # outside the completion: a separator
+    is_A, is_dot, is_digit = tok == STOI['A'], tok == EOS, tok < 10
+    fmt = (tok == STOI['T']).any(1) & is_A.any(1)
+    B = tok.shape[0]
+    run = torch.zeros(B, dtype=torch.long)
+    val = torch.zeros(B, dtype=torch.long)
+    dot = torch.zeros(B, dtype=torch.bool)
+    hit = torch.zeros(B, dtype=torch.bool)
+    ans = torch.zeros(B, dtype=torch.long)
+    for i in range(tok.shape[1] - 1, -1, -1):
+        # run/val/dot describe the digit run starting at column i+1
+        m = is_A[:, i] & (run > 0) & dot
+        hit, ans = hit | m, torch.where(m, val, ans)
+        d = is_digit[:, i]
+        val = (tok[:, i] * 10 ** run.clamp(max=3) + val).clamp(max=100).masked_fill(~d, 0)
+        dot = torch.where(d, dot, is_dot[:, i])
+        run = (run + 1).masked_fill(~d, 0)
+    ok = target >= 0
+    acc = hit & (ans == target) & ok
+    # same float arithmetic as `reward` (0.0 + 0.1 + 1.0 in double precision)
+    return (0.1 * (fmt & ok).double() + 1.0 * acc.double()).float()
+
+
 # --------------------------------------------------------------------------
 # Stochastic sampling with log-probs, used by GRPO and rejection sampling
 # --------------------------------------------------------------------------
-def sample_completion(model, prompt_ids, max_new=16, temperature=1.0):
+def sample_completion(model, prompt_ids, max_new=16, temperature=1.0, use_cache=True,
+                      constrained=False):
     """
     Sample one completion from `prompt_ids` (a (1, P) LongTensor).
     Returns (full_sequence, summed_log_prob_of_generated_tokens).
     The summed log-prob is what GRPO multiplies by the advantage.
     """
     x = prompt_ids.clone()
+    cache = KVCache() if use_cache else None
+    state = torch.zeros(1, dtype=torch.long)
     logps = []
     for _ in range(max_new):
-        logits = model(x[:, -BLOCK:])[:, -1, :] / temperature
+        logits = _step_logits(model, x, cache) / temperature
+        if constrained:
+            logits = _constrain(logits, state)
         probs = F.softmax(logits, -1)
         nxt = torch.multinomial(probs, 1)
         logps.append(F.log_softmax(logits, -1).gather(1, nxt))
+        if constrained:
+            state = FSA_NEXT[state, nxt[:, 0]]
         x = torch.cat([x, nxt], 1)
         if nxt.item() == EOS:
             break
     return x, torch.cat(logps, 1).sum(1)
 
 
+def sample_group(model, prompt_ids, G, max_new=16, temperature=1.0, constrained=False):
+    """
+    Sample G completions of one prompt (a (1, P) LongTensor) in one batched
+    loop -- the vectorized form of calling `sample_completion` G times.
+    Returns (seqs, gen_mask, logps):
+      seqs      (G, P+T) prompt + completion, PAD after a row's EOS
+      gen_mask  (G, P+T) True on each row's generated tokens (EOS included)
+      logps     (G,)     summed log-prob of those tokens, with grad
+    """
+    x = prompt_ids.expand(G, -1).clone()
+    valid = torch.ones_like(x, dtype=torch.bool)
+    seqs, gen_mask, logps = _decode_batch(model, x, valid, max_new, temperature, greedy=False,
+                                          constrained=constrained)
+    gen_mask[:, :prompt_ids.shape[1]] = False
+    return seqs, gen_mask, logps
+
+
+def _fsa_states(seqs, gen_mask):
+    """Automaton state before each column's token; the (permissive) done
+    state outside the generated span."""
+    done_state = FSA_NEXT.shape[0] - 1
+    states = torch.full_like(seqs, done_state)
+    state = torch.zeros(seqs.shape[0], dtype=torch.long)
+    for j in range(seqs.shape[1]):
+        g = gen_mask[:, j]
+        states[:, j] = torch.where(g, state, done_state)
+        state = torch.where(g, FSA_NEXT[state, seqs[:, j]].clamp(min=0), state)
+    return states
+
+
+def token_logprobs(model, seqs, valid, gen_mask, temperature=1.0, constrained=False):
+    """
+    Teacher-forced scoring of finished rollouts: (B, T-1) log-probs of each
+    token given its prefix (0.0 off the generated span), from ONE batched
+    forward over the padded sequences.
+    """
+    if seqs.shape[1] > BLOCK:
+        raise ValueError(f'rollouts longer than BLOCK={BLOCK} cannot be re-scored in one pass')
+    logits = model.forward_cached(seqs, KVCache(), valid)[:, :-1] / temperature
+    if constrained:
+        logits = _constrain(logits, _fsa_states(seqs, gen_mask)[:, 1:])
+    lp = F.log_softmax(logits, -1).gather(2, seqs[:, 1:, None]).squeeze(2)
+    return lp.masked_fill(~gen_mask[:, 1:], 0.0)
+
+
+def sequence_logprobs(model, seqs, valid, gen_mask, temperature=1.0, constrained=False):
+    """
+    The summed log-prob of each row's generated tokens (`token_logprobs`
+    summed). Pair it with sampling under `torch.no_grad()` and the
+    sampling loop never builds an autograd graph; the gradient comes from
+    this single pass instead. With dropout off (`model.eval()`) the result
+    equals the log-probs accumulated while sampling.
+    """
+    return token_logprobs(model, seqs, valid, gen_mask, temperature, constrained).sum(1)
+
+
 @torch.no_grad()
-def sample_text(model, prompt, max_new=16, temperature=1.0):
+def sample_text(model, prompt, max_new=16, temperature=1.0, use_cache=True, constrained=False):
     """Sample a completion and return the full decoded string (no grad)."""
     x = torch.tensor([encode(prompt)])
+    cache = KVCache() if use_cache else None
+    state = torch.zeros(1, dtype=torch.long)
     for _ in range(max_new):
-        logits = model(x[:, -BLOCK:])[:, -1, :] / temperature
+        logits = _step_logits(model, x, cache) / temperature
+        if constrained:
+            logits = _constrain(logits, state)
         nxt = torch.multinomial(F.softmax(logits, -1), 1)
+        if constrained:
+            state = FSA_NEXT[state, nxt[:, 0]]
         x = torch.cat([x, nxt], 1)
         if nxt.item() == EOS:
             break
     return decode(x[0].tolist())
+
+
+# --------------------------------------------------------------------------
+# Rejection sampling: the model as a data factory
+#   Every still-unsolved prompt gets one more sample per round, all of them
+#   decoded together; prompts retire as soon as they have `keep` verified-
+#   correct completions (or run out of tries).
+# --------------------------------------------------------------------------
+@torch.no_grad()
+def rejection_sample(model, prompts, max_tries=12, keep=1, temperature=1.0,
+                     batch_size=1024, constrained=False, sampler=None):
+    """
+    Batched best-of-N over bare 'a+b=' prompts. Returns (kept, stats):
+      kept   verified-correct full strings, in prompt order (<= keep each)
+      stats  samples drawn, tokens generated, kept count, kept_rate
+             (kept / samples), the fraction of prompts that reached `keep`,
+             and a histogram {samples drawn for one kept completion: count}
+    `batch_size` caps the rows decoded at once for large prompt sets.
+    A `sampler` (e.g. `CurriculumSampler`) is updated with every outcome.
+    """
+    n = len(prompts)
+    target = torch.tensor([prompt_target(p) for p in prompts])
+    tries = torch.zeros(n, dtype=torch.long)
+    found = torch.zeros(n, dtype=torch.long)
+    since = torch.zeros(n, dtype=torch.long)     # samples since the last keep
+    kept = [[] for _ in range(n)]
+    hist = Counter()
+    tokens = 0
+    while True:
+        active = ((found < keep) & (tries < max_tries)).nonzero().flatten()
+        if len(active) == 0:
+            break
+        for chunk in active.split(batch_size):
+            x, valid = left_pad([prompts[i] for i in chunk.tolist()])
+            seqs, valid, _ = _decode_batch(model, x, valid, temperature=temperature,
+                                           greedy=False, constrained=constrained)
+            gen_mask = valid.clone()
+            gen_mask[:, :x.shape[1]] = False
+            tokens += gen_mask.sum().item()
+            ok = reward_ids(seqs, gen_mask, target[chunk]) >= 1.0   # accuracy credit
+            if sampler is not None:
+                sampler.update([prompts[i] for i in chunk.tolist()], ok[:, None])
+            tries[chunk] += 1
+            since[chunk] += 1
+            for row in ok.nonzero().flatten().tolist():
+                i = chunk[row].item()
+                kept[i].append(decode(seqs[row][valid[row]].tolist()))
+                hist[since[i].item()] += 1
+                since[i] = 0
+                found[i] += 1
+    samples, n_kept = tries.sum().item(), found.sum().item()
+    stats = {
+        'samples': samples,
+        'tokens': tokens,
+        'kept': n_kept,
+        'kept_rate': n_kept / max(samples, 1),
+        'prompts_done': (found >= keep).float().mean().item(),
+        'samples_per_kept': dict(sorted(hist.items())),
+    }
+    return [t for ts in kept for t in ts], stats
+
+
+# --------------------------------------------------------------------------
+# Distillation with cached teacher soft targets
+#   The distill set is fixed, so the teacher's softened next-token
+#   distributions are computed once up front; the student loop only reads
+#   them. top_k keeps just the k most likely tokens per position (indices +
+#   probs, the rest lumped together) when the dense (N, L, V) table would be
+#   too big.
+# --------------------------------------------------------------------------
+class DistillDataset(SFTDataset):
+    """
+    An `SFTDataset` that also holds the teacher's softmax(logits / T) for
+    every position. `batch(k)` returns (x, soft): soft is the dense
+    (k, L-1, V) target, or an (indices, probs) pair of (k, L-1, top_k).
+    Top-k probabilities are kept as they are, not renormalized: the mass
+    left over is what `distill_loss` puts in its "rest" bucket.
+    """
+
+    def __init__(self, teacher, strings, T=2.0, top_k=None, seed=0):
+        super().__init__(strings, seed)
+        self.T, self.top_k = T, top_k
+        self.probs, self.idx = _soft_targets(teacher, self.data, T, top_k)
+
+    def batch(self, k=16):
+        idx = torch.randint(len(self), (k,), generator=self.gen)
+        L = int(self.lengths[idx].max())
+        probs = self.probs[idx, :L - 1]
+        soft = probs if self.idx is None else (self.idx[idx, :L - 1], probs)
+        return self.data[idx, :L], soft
+
+
+class PackedDistillDataset(PackedSFTDataset):
+    """
+    `DistillDataset` on packed rows: the teacher scores each row with its
+    doc_ids, so every example sees only itself. `batch(k)` returns
+    (x, doc_ids, soft); pass doc_ids on to `distill_loss`.
+    """
+
+    def __init__(self, teacher, strings, T=2.0, top_k=None, n_rows=512, seed=0):
+        super().__init__(strings, n_rows, seed)
+        self.T, self.top_k = T, top_k
+        self.probs, self.idx = _soft_targets(teacher, self.data, T, top_k, self.doc)
+
+    def batch(self, k=16):
+        idx = torch.randint(len(self), (k,), generator=self.gen)
+        soft = self.probs[idx] if self.idx is None else (self.idx[idx], self.probs[idx])
+        return self.data[idx], self.doc[idx], soft
+
+
+@torch.no_grad()
+def _soft_targets(teacher, x, T, top_k=None, doc_ids=None):
+    """Teacher softmax(logits / T) for x[:, :-1]: (probs, None) or top-k (probs, idx)."""
+    d = None if doc_ids is None else doc_ids[:, :-1]
+    with eval_mode(teacher):
+        probs = F.softmax(teacher(x[:, :-1], d) / T, -1)
+    return probs.topk(top_k, -1) if top_k else (probs, None)
+
+
+def distill_loss(student, x, soft, T=2.0, doc_ids=None):
+    """
+    T^2-scaled KL(teacher || student) per sequence (per row when packed),
+    the notebook 03 objective. `soft` is a dense target or a sparse (indices, probs) pair.
+    The sparse KL runs over the kept tokens plus one "rest" bucket holding
+    the mass outside them on both sides: it equals the dense KL when the
+    teacher's tail is empty and never exceeds it otherwise. For packed rows
+    pass doc_ids: positions whose next token starts another example (or is
+    filler) drop out, like in `lm_targets`.
+    """
+    d = None if doc_ids is None else doc_ids[:, :-1]
+    logq = F.log_softmax(student(x[:, :-1], d) / T, -1)
+    if isinstance(soft, tuple):
+        idx, p = soft
+        logq = logq.gather(-1, idx)
+        p_rest = (1 - p.sum(-1)).clamp_min(0)
+        q_rest = (1 - logq.exp().sum(-1)).clamp_min(1e-12)
+        kl = (p * (p.clamp_min(1e-12).log() - logq)).sum(-1)
+        kl = kl + p_rest * (p_rest.clamp_min(1e-12).log() - q_rest.log())
+    else:
+        kl = F.kl_div(logq, soft, reduction='none').sum(-1)
+    if doc_ids is not None:
+        kl = kl * (doc_ids[:, 1:] == doc_ids[:, :-1])
+    return kl.sum() / x.shape[0] * T ** 2
+
+
+# --------------------------------------------------------------------------
+# Speculative decoding: a small draft model proposes, the teacher verifies
+#   The draft (e.g. the distilled student) guesses k tokens one by one; the
+#   teacher scores all k (plus one extra position) in a single forward.
+#   Draft token d is kept with probability min(1, p(d) / q(d)); the first
+#   rejected position is resampled from max(0, p - q), renormalized. That
+#   rule makes the output distributed exactly as if the teacher had sampled
+#   alone. With greedy=True a draft is kept iff it is the teacher's argmax,
+#   so the output equals `generate(teacher, ...)`.
+# --------------------------------------------------------------------------
+@torch.no_grad()
+def speculative_generate(teacher, draft, prompt, max_new=16, k=4, temperature=1.0,
+                         greedy=False):
+    """
+    Decode `prompt` with draft-then-verify. Both models share the vocab.
+    Returns (text, stats): stats counts drafted tokens, accepted tokens
+    and teacher forward passes.
+    """
+    x = torch.tensor([encode(prompt)])
+    if x.shape[1] + max_new > BLOCK:
+        raise ValueError(f'prompt + max_new must fit in BLOCK={BLOCK}')
+    t_cache, d_cache = KVCache(), KVCache()
+    stats = {'drafted': 0, 'accepted': 0, 'teacher_calls': 0}
+    n_gen = 0
+    while n_gen < max_new:
+        kk = min(k, max_new - n_gen - 1)
+        # 1. the draft proposes kk tokens (its cache only ever sees new tokens)
+        seq, qs = x, []
+        for _ in range(kk):
+            q = F.softmax(draft.forward_cached(seq[:, len(d_cache):], d_cache)[:, -1]
+                          / temperature, -1)
+            d = q.argmax(-1, keepdim=True) if greedy else torch.multinomial(q, 1)
+            qs.append(q[0])
+            seq = torch.cat([seq, d], 1)
+        # 2. one teacher pass: a distribution for every draft + one bonus slot
+        logits = teacher.forward_cached(seq[:, len(t_cache):], t_cache)[0, -(kk + 1):]
+        ps = F.softmax(logits / temperature, -1)
+        stats['teacher_calls'] += 1
+        stats['drafted'] += kk
+        # 3. accept left to right; stop at the first rejection
+        drafts = seq[0, x.shape[1]:].tolist()
+        n = 0
+        for p, q, d in zip(ps, qs, drafts):
+            if greedy:
+                ok = d == p.argmax().item()
+            else:
+                ok = torch.rand(()).item() < (p[d] / q[d]).item()
+            if not ok:
+                break
+            n += 1
+        p = ps[n]
+        if greedy:
+            t = p.argmax().item()
+        elif n < kk:                                    # resample the rejected slot
+            res = (p - qs[n]).clamp(min=0)
+            t = torch.multinomial(res if res.sum() > 0 else p, 1).item()
+        else:                                           # all accepted: bonus token
+            t = torch.multinomial(p, 1).item()
+        stats['accepted'] += n
+        new = drafts[:n] + [t]
+        if EOS in new:
+            new = new[:new.index(EOS) + 1]
+        # roll both caches back to the accepted prefix
+        t_cache.truncate(x.shape[1] + n)
+        d_cache.truncate(min(len(d_cache), x.shape[1] + n))
+        x = torch.cat([x, torch.tensor([new])], 1)
+        n_gen += len(new)
+        if new[-1] == EOS:
+            break
+    return decode(x[0].tolist()), stats
+
+
+# --------------------------------------------------------------------------
+# Batched GRPO: P prompts x G completions per optimizer step
+# --------------------------------------------------------------------------
+class GRPOTrainer:
+    """
+    GRPO on many prompts at once. Each `step()` samples G completions for
+    each of P prompts in a single decode loop, scores them on the token ids
+    with `reward_ids` (same values as `reward`), z-scores the rewards
+    within each prompt's group, and takes one optimizer step on the whole
+    P*G batch. With P=1 and filter_groups=True (tied groups skip the
+    optimizer step) this is notebook 02's one-prompt `grpo_step`; with the
+    default filter_groups=False a tied group still steps the optimizer,
+    so AdamW momentum and weight decay move the weights.
+
+    `history` keeps one stats dict per step (loss, mean reward, fraction
+    of zero-variance groups, step time, rollouts and rollouts/s, generated
+    tokens and tokens/s).
+    The completions are only decoded to strings on demand through
+    `last_completions`.
+
+    rescore=True samples under `torch.no_grad()` and gets the log-probs
+    from one teacher-forced pass (`sequence_logprobs`) instead of keeping
+    the graph of every decode step alive until the backward.
+
+    With a `sampler` (e.g. `CurriculumSampler`), default prompts are drawn
+    from it and every group's outcomes are fed back to it.
+
+    epochs > 1 reuses each rollout batch for that many updates with a
+    PPO-style clipped surrogate (`ppo_update`); sampling then runs without
+    grad, as with rescore=True.
+
+    A frozen `ref_model` (e.g. the cold-start checkpoint) adds a
+    `kl_coef`-weighted KL(policy || reference) penalty. The reference is
+    scored once per rollout batch, in one no-grad teacher-forced pass whose
+    per-token log-probs are reused by every epoch; `ref_time` in the stats
+    is that pass's cost. Both sides of the KL are scored with dropout off,
+    so a policy equal to its reference gets exactly zero penalty.
+    """
+
+    def __init__(self, model, opt, P=8, G=4, max_new=16, temperature=1.0, constrained=False,
+                 rescore=False, filter_groups=False, resample_rounds=0, sampler=None,
+                 epochs=1, clip=0.2, ref_model=None, kl_coef=0.05):
+        self.model, self.opt = model, opt
+        self.P, self.G = P, G
+        self.max_new, self.temperature = max_new, temperature
+        self.constrained, self.rescore = constrained, rescore
+        self.filter_groups, self.resample_rounds = filter_groups, resample_rounds
+        self.sampler = sampler
+        self.epochs, self.clip = epochs, clip
+        self.ref_model, self.kl_coef = ref_model, kl_coef
+        self.history = []
+        self._last = None
+
+    @property
+    def last_completions(self):
+        """Decoded completions from the most recent step."""
+        if self._last is None:
+            return []
+        seqs, gen_mask = self._last
+        return [decode(row[m].tolist()) for row, m in zip(seqs, gen_mask)]
+
+    def _draw(self, n):
+        if self.sampler is not None:
+            return self.sampler.sample(n)
+        return [random_prompt()[0] for _ in range(n)]
+
+    def rollout(self, prompts, score=True, sizes=None):
+        """
+        Sample G completions per prompt string (or sizes[i] for prompt i).
+        Returns (seqs, valid, gen_mask, logps), one row per completion. When
+        sampling runs without grad and score=False, the scoring pass is left
+        to the caller and logps is None.
+        """
+        sizes = sizes or [self.G] * len(prompts)
+        rows = [p for p, g in zip(prompts, sizes) for _ in range(g)]
+        x, valid = left_pad(rows)
+        no_grad = self.rescore or self.epochs > 1 or self.ref_model is not None
+        with torch.set_grad_enabled(not no_grad):
+            seqs, valid, logps = _decode_batch(self.model, x, valid, self.max_new,
+                                               self.temperature, greedy=False,
+                                               constrained=self.constrained)
+        gen_mask = valid.clone()
+        gen_mask[:, :x.shape[1]] = False
+        if no_grad:
+            logps = sequence_logprobs(self.model, seqs, valid, gen_mask, self.temperature,
+                                      self.constrained) if score else None
+        return seqs, valid, gen_mask, logps
+
+    def rewards(self, prompts, seqs, gen_mask, sizes=None):
+        """(P, G) rewards of a rollout of `prompts`; flat when `sizes` is given."""
+        if sizes is None:
+            target = torch.tensor([prompt_target(p) for p in prompts]).repeat_interleave(self.G)
+            return reward_ids(seqs, gen_mask, target).view(len(prompts), self.G)
+        target = torch.tensor([prompt_target(p) for p in prompts])
+        return reward_ids(seqs, gen_mask, target.repeat_interleave(torch.tensor(sizes)))
+
+    def reference_logprobs(self, seqs, valid, gen_mask):
+        """Per-token log-probs of a rollout batch under the frozen reference."""
+        with torch.no_grad(), eval_mode(self.ref_model):
+            return token_logprobs(self.ref_model, seqs, valid, gen_mask, self.temperature,
+                                  self.constrained)
+
+    @staticmethod
+    def ref_kl(lp, ref_lp):
+        """Per-sequence k3 estimate of KL(policy || reference), mean over rows
+        (0 off the generated span, where both log-probs are 0)."""
+        d = ref_lp - lp
+        return (d.exp() - d - 1).sum(1).mean()
+
+    def update(self, logps, r, penalty=None):
+        """Policy-gradient step from (P*G,) log-probs and (P, G) rewards,
+        plus an optional scalar `penalty` term."""
+        adv = (r - r.mean(1, keepdim=True)) / (r.std(1, keepdim=True) + 1e-6)
+        loss = -(logps * adv.flatten()).mean()
+        if penalty is not None:
+            loss = loss + penalty
+        self.opt.zero_grad(); loss.backward(); self.opt.step()
+        return loss
+
+    def ppo_update(self, seqs, valid, gen_mask, r, ref_lp=None):
+        """
+        `epochs` clipped-surrogate steps on one rollout batch. Every epoch
+        scores with dropout off, so the ratio only moves when the weights
+        do. The old per-token log-probs are the first epoch's, detached, so
+        epoch 1 is the plain GRPO step (taken without dropout); later
+        epochs clip each token's ratio to 1 +- clip. Returns (loss,
+        {'kl', 'clip_frac'}): the k3 estimate of KL(old || current) seen by
+        the last epoch, and the share of clipped tokens averaged over the
+        epochs after the first. `ref_lp` adds the reference KL penalty to
+        every epoch.
+        """
+        adv = ((r - r.mean(1, keepdim=True)) / (r.std(1, keepdim=True) + 1e-6)).flatten()[:, None]
+        mask = gen_mask[:, 1:]
+        clipped = []
+        with eval_mode(self.model):   # same (no) dropout mask for old and new
+            for epoch in range(self.epochs):
+                lp = token_logprobs(self.model, seqs, valid, gen_mask, self.temperature,
+                                    self.constrained)
+                if epoch == 0:
+                    old = lp.detach()
+                log_ratio = lp - old
+                ratio = log_ratio.exp()
+                if epoch:
+                    clipped.append(((ratio.detach() - 1).abs() > self.clip)[mask])
+                surr = torch.min(ratio * adv, ratio.clamp(1 - self.clip, 1 + self.clip) * adv)
+                loss = -surr.masked_fill(~mask, 0.0).sum(1).mean()
+                if ref_lp is not None:
+                    ref_kl = self.ref_kl(lp, ref_lp)
+                    loss = loss + self.kl_coef * ref_kl
+                self.opt.zero_grad(); loss.backward(); self.opt.step()
+        lr_ = log_ratio.detach()[mask]
+        extra = {
+            'kl': (lr_.exp() - 1 - lr_).mean().item(),
+            'clip_frac': torch.cat(clipped).float().mean().item() if clipped else 0.0,
+        }
+        if ref_lp is not None:
+            extra['ref_kl'] = ref_kl.item()
+        return loss, extra
+
+    def step(self, prompts=None):
+        """
+        One GRPO update on `prompts` (bare 'a+b=' strings; default: P random).
+
+        A group whose G rewards are all equal has zero advantage, so its
+        backward is wasted work; `zero_var_frac` in the stats logs how many
+        sampled groups were like that. filter_groups=True drops them before
+        the backward, and resample_rounds > 0 refills the batch with fresh
+        random prompts for up to that many extra sampling rounds (dynamic
+        sampling). If nothing is left, the optimizer step is skipped.
+        """
+        t0 = time.perf_counter()
+        if prompts is None:
+            prompts = self._draw(self.P)
+        need, kept, sampled = len(prompts), [], []
+        rounds = self.resample_rounds + 1 if self.filter_groups else 1
+        # score right away only if nothing below re-scores the kept rows
+        score = not (self.filter_groups or self.epochs > 1 or self.ref_model is not None)
+        for _ in range(rounds):
+            seqs, valid, gen_mask, logps = self.rollout(prompts, score=score)
+            r = self.rewards(prompts, seqs, gen_mask)
+            if self.sampler is not None:
+                self.sampler.update(prompts, r >= 1.0)
+            keep = ~(r == r[:, :1]).all(1)
+            if not self.filter_groups:
+                keep = torch.ones_like(keep)
+            rows = keep.repeat_interleave(self.G)
+            sampled.append((seqs, gen_mask, r))
+            kept.append((seqs[rows], valid[rows], gen_mask[rows],
+                         None if logps is None else logps[rows], r[keep]))
+            need -= int(keep.sum())
+            if need == 0:
+                break
+            prompts = self._draw(need)
+        seqs, valid, gen_mask = (_cat_rows([k[i] for k in kept], fill) for i, fill in
+                                 ((0, PAD), (1, False), (2, False)))
+        r = torch.cat([k[4] for k in kept])
+        loss, extra, ref_lp = torch.zeros(()), {}, None
+        if len(r) and self.ref_model is not None:
+            t_ref = time.perf_counter()
+            ref_lp = self.reference_logprobs(seqs, valid, gen_mask)
+            extra['ref_time'] = time.perf_counter() - t_ref
+        if len(r) and self.epochs > 1:
+            loss, ppo = self.ppo_update(seqs, valid, gen_mask, r, ref_lp)
+            extra.update(ppo)
+        elif ref_lp is not None:
+            with eval_mode(self.model):   # the reference is scored without dropout too
+                lp = token_logprobs(self.model, seqs, valid, gen_mask, self.temperature,
+                                    self.constrained)
+            ref_kl = self.ref_kl(lp, ref_lp)
+            loss = self.update(lp.sum(1), r, self.kl_coef * ref_kl)
+            extra['ref_kl'] = ref_kl.item()
+        elif len(r):
+            if self.rescore and self.filter_groups:
+                logps = sequence_logprobs(self.model, seqs, valid, gen_mask, self.temperature,
+                                          self.constrained)
+            else:
+                logps = torch.cat([k[3] for k in kept])
+            loss = self.update(logps, r)
+        dt = time.perf_counter() - t0
+        all_r = torch.cat([s[2] for s in sampled])
+        self._last = (_cat_rows([s[0] for s in sampled], PAD),
+                      _cat_rows([s[1] for s in sampled], False))
+        stats = {
+            'loss': loss.item(),
+            'mean_reward': all_r.mean().item(),
+            'zero_var_frac': (all_r == all_r[:, :1]).all(1).float().mean().item(),
+            'groups_used': len(r),
+            'sample_rounds': len(sampled),
+            'step_time': dt,
+            'rollouts': all_r.numel(),
+            'rollouts_per_s': all_r.numel() / dt,
+            'tokens': self._last[1].sum().item(),
+            'tokens_per_s': self._last[1].sum().item() / dt,
+        }
+        stats.update(extra)
+        self.history.append(stats)
+        return stats
+
+
+def _cat_rows(blocks, fill):
+    """Stack (n_i, T_i) row blocks, right-filling the shorter ones with `fill`."""
+    T = max(b.shape[1] for b in blocks)
+    return torch.cat([torch.cat([b, b.new_full((len(b), T - b.shape[1]), fill)], 1)
+                      for b in blocks])
+
+
+# --------------------------------------------------------------------------
+# Adaptive group sizes: spend the rollout budget where rewards disagree
+#   A prompt the model always solves (or always fails) gives every sample
+#   the same reward, and its group teaches nothing. The allocator keeps
+#   running reward statistics per (a, b) and gives the big groups to the
+#   prompts whose rewards still vary.
+# --------------------------------------------------------------------------
+class GroupAllocator:
+    """
+    Per-prompt reward mean/variance (exponential moving averages, `decay`
+    per visit) for the 100 a+b prompts, and a split of `budget` rollouts
+    per step into groups of min_G..max_G samples.
+
+    `allocate()` first picks budget // G prompts to visit, drawn without
+    replacement with probability proportional to their reward variance
+    (so a solved prompt is still revisited now and then and a stale
+    estimate can recover), then splits the whole budget over just those
+    prompts in proportion to their reward std. Unseen prompts start at
+    `prior_var`. Every group gets at least min_G >= 2 samples: a group of
+    one has no std to z-score against.
+    """
+
+    def __init__(self, budget=32, G=4, min_G=2, max_G=16, decay=0.9, prior_var=0.25,
+                 min_var=1e-3):
+        if not 2 <= min_G <= max_G:
+            raise ValueError(f'need 2 <= min_G <= max_G, got min_G={min_G}, max_G={max_G}')
+        if budget < min_G:
+            raise ValueError(f'budget {budget} is smaller than one group of min_G={min_G}')
+        self.budget, self.min_G, self.max_G = budget, min_G, max_G
+        self.n_prompts = max(1, min(100, budget // G, budget // min_G))
+        self.decay, self.min_var = decay, min_var
+        self.mean = torch.zeros(10, 10)
+        self.var = torch.full((10, 10), prior_var)
+        self.visits = torch.zeros(10, 10, dtype=torch.long)
+
+    def allocate(self):
+        """Returns (pairs, sizes): the (a, b) prompts to sample and their G."""
+        var = (self.var + self.min_var).flatten()
+        idx = torch.multinomial(var, self.n_prompts).tolist()
+        std = var[idx].sqrt()
+        share = (self.budget * std / std.sum()).tolist()
+        sizes = [self.min_G] * len(idx)
+        # hand out the rest one rollout at a time, to the group furthest
+        # below its share that is not yet at max_G
+        for _ in range(self.budget - sum(sizes)):
+            open_ = [j for j in range(len(idx)) if sizes[j] < self.max_G]
+            if not open_:
+                break
+            sizes[max(open_, key=lambda j: share[j] - sizes[j])] += 1
+        return [divmod(i, 10) for i in idx], sizes
+
+    def update(self, pairs, groups):
+        """Fold each group's rewards into its prompt's running statistics."""
+        for (a, b), r in zip(pairs, groups):
+            m, v = r.mean(), r.var(unbiased=False)
+            if self.visits[a, b]:
+                m = self.decay * self.mean[a, b] + (1 - self.decay) * m
+                v = self.decay * self.var[a, b] + (1 - self.decay) * v
+            self.mean[a, b], self.var[a, b] = m, v
+            self.visits[a, b] += 1
+
+
+class AdaptiveGRPOTrainer(GRPOTrainer):
+    """
+    `GRPOTrainer` whose groups come from a `GroupAllocator`: each step
+    samples `allocator.budget` completions split unevenly over prompts,
+    z-scores rewards within each (ragged) group, and feeds the rewards back
+    into the allocator. `rollouts` counts completions sampled so far.
+
+    Only the sampling options (max_new, temperature, constrained, rescore)
+    carry over; the allocator picks the prompts, and group filtering,
+    curriculum samplers, PPO epochs and the reference KL are rejected.
+    """
+
+    UNSUPPORTED = {'filter_groups': False, 'resample_rounds': 0, 'sampler': None,
+                   'epochs': 1, 'ref_model': None}
+
+    def __init__(self, model, opt, allocator=None, **kwargs):
+        bad = [k for k, off in self.UNSUPPORTED.items() if kwargs.get(k, off) != off]
+        if bad:
+            raise ValueError(f'AdaptiveGRPOTrainer does not support {", ".join(bad)}')
+        super().__init__(model, opt, **kwargs)
+        self.allocator = allocator or GroupAllocator()
+        self.rollouts = 0
+
+    def step(self, prompts=None):
+        t0 = time.perf_counter()
+        pairs, sizes = self.allocator.allocate()
+        prompts = [f'{a}+{b}=' for a, b in pairs]
+        seqs, valid, gen_mask, logps = self.rollout(prompts, sizes=sizes)
+        r = self.rewards(prompts, seqs, gen_mask, sizes)
+        groups = r.split(sizes)
+        self.allocator.update(pairs, groups)
+        adv = torch.cat([(g - g.mean()) / (g.std() + 1e-6) for g in groups])
+        loss = -(logps * adv).mean()
+        self.opt.zero_grad(); loss.backward(); self.opt.step()
+        dt = time.perf_counter() - t0
+        self.rollouts += r.numel()
+        self._last = (seqs, gen_mask)
+        stats = {
+            'loss': loss.item(),
+            'mean_reward': r.mean().item(),
+            'groups': len(sizes),
+            'max_G': max(sizes),
+            'step_time': dt,
+            'rollouts': r.numel(),
+            'rollouts_per_s': r.numel() / dt,
+            'tokens': gen_mask.sum().item(),
+            'tokens_per_s': gen_mask.sum().item() / dt,
+        }
+        self.history.append(stats)
+        return stats
+
+
+# --------------------------------------------------------------------------
+# Curriculum: sample the prompts the model still gets wrong
+# --------------------------------------------------------------------------
+class CurriculumSampler:
+    """
+    A drop-in for `random_prompt()` that prefers unsolved sums. `success`
+    is a (10, 10) table of per-(a, b) success rates, an EMA updated from
+    the outcomes of rollouts the trainer already ran (no extra decoding).
+    `sample(k)` draws prompts with probability proportional to
+    (1 - success + floor) ** (1 / temperature): temperature=1 follows the
+    failure rate, larger values flatten towards uniform, smaller ones
+    focus on the hardest sums. `floor` keeps solved sums from vanishing.
+    """
+
+    def __init__(self, temperature=1.0, decay=0.8, prior=0.0, floor=0.05, seed=0):
+        self.temperature, self.decay, self.floor = temperature, decay, floor
+        self.success = torch.full((10, 10), prior)
+        self.gen = torch.Generator().manual_seed(seed)
+
+    def weights(self):
+        return (1 - self.success + self.floor).flatten() ** (1 / self.temperature)
+
+    def sample(self, k):
+        idx = torch.multinomial(self.weights(), k, replacement=True, generator=self.gen)
+        return [f'{i // 10}+{i % 10}=' for i in idx.tolist()]
+
+    def update(self, prompts, correct):
+        """`correct`: one row of bools (one per sample) for each prompt."""
+        for p, ok in zip(prompts, correct):
+            a, b = int(p[0]), int(p[2])
+            rate = ok.float().mean()
+            self.success[a, b] = self.decay * self.success[a, b] + (1 - self.decay) * rate
+
+
+# --------------------------------------------------------------------------
+# Stage checkpoints, content-addressed by the config that produced them
+#   key = hash(stage name, config, parent key). Same inputs -> same key ->
+#   the stage loads from disk instead of training. Tensors are memory-mapped,
+#   so a load only touches the pages that are actually read.
+# --------------------------------------------------------------------------
+class CheckpointStore:
+    """
+    A directory of stage outputs: `<key>.pt` (a TinyLM state_dict) or
+    `<key>.json` (plain data such as a kept-example list), each next to a
+    `<key>.meta.json` recording the stage, config, parent and architecture.
+
+    Only the config is hashed, not the stage's code: after changing what a
+    stage does, change its config too (e.g. a 'version' entry).
+    """
+
+    def __init__(self, root='checkpoints'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, name, config, parent=None):
+        blob = json.dumps({'stage': name, 'config': config, 'parent': parent}, sort_keys=True)
+        return hashlib.sha256(blob.encode()).hexdigest()[:16]
+
+    def _path(self, key, ext):
+        return os.path.join(self.root, f'{key}.{ext}')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key, 'meta.json'))
+
+    def meta(self, key):
+        with open(self._path(key, 'meta.json')) as f:
+            return json.load(f)
+
+    def save(self, key, obj, meta):
+        """Write `obj` (a TinyLM or JSON-able data); the meta file goes last,
+        so a half-written entry is never treated as cached."""
+        if isinstance(obj, nn.Module):
+            meta = dict(meta, kind='model', arch=obj.config())
+            torch.save(obj.state_dict(), self._path(key, 'pt.tmp'))
+            os.replace(self._path(key, 'pt.tmp'), self._path(key, 'pt'))
+        else:
+            meta = dict(meta, kind='data')
+            with open(self._path(key, 'json'), 'w') as f:
+                json.dump(obj, f)
+        with open(self._path(key, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(self._path(key, 'meta.json.tmp'), self._path(key, 'meta.json'))
+
+    def load(self, key):
+        """The stored TinyLM (weights memory-mapped, copy-on-write) or data."""
+        meta = self.meta(key)
+        if meta['kind'] == 'data':
+            with open(self._path(key, 'json')) as f:
+                return json.load(f)
+        state = torch.load(self._path(key, 'pt'), mmap=True, weights_only=True)
+        model = TinyLM(**meta['arch'])
+        model.load_state_dict(state, assign=True)
+        return model
+
+    def stage(self, name, fn, config, parent=None):
+        """
+        Run `fn(parent_output, **config)` once per distinct (name, config,
+        parent) and return (output, key); later calls load it instead.
+        `parent` is the key of the stage this one builds on, or None. RNGs
+        are seeded from config['seed'] (if present) before `fn` runs.
+        """
+        key = self.key(name, config, parent)
+        if key in self:
+            return self.load(key), key
+        if 'seed' in config:
+            torch.manual_seed(config['seed']); random.seed(config['seed'])
+        t0 = time.perf_counter()
+        out = fn(self.load(parent) if parent else None, **config)
+        self.save(key, out, {'stage': name, 'config': config, 'parent': parent,
+                             'seconds': time.perf_counter() - t0})
+        return out, key
+
+
+# --------------------------------------------------------------------------
+# Notebook stages: the cold-start SFT and GRPO bodies notebooks 02 and 03
+# both hand to `CheckpointStore.stage`, defined once so that one store key
+# always means one piece of code. Logging kwargs (log_every, history) are
+# bound with functools.partial and stay out of the hashed config.
+# --------------------------------------------------------------------------
+def cold_start_stage(_, seed, n_examples=20, steps=400, lr=3e-3, batch=16, log_every=0):
+    """
+    Notebook 02's stage A: shuffle the 100 examples, keep the first
+    `n_examples`, and SFT a fresh TinyLM on them. log_every > 0 prints the
+    first few examples and the loss every that many steps.
+    """
+    exs = all_examples()
+    random.shuffle(exs)
+    exs = exs[:n_examples]
+    model = TinyLM()
+    if log_every:
+        print(f'cold-start set ({n_examples} examples), first 5:')
+        for ex in exs[:5]:
+            print('  ', ex)
+        print('-' * 60)
+        print('params:', round(n_params(model), 1), 'K')
+    ds = SFTDataset(exs)
+    opt = torch.optim.AdamW(model.parameters(), lr=lr)
+    for step in range(steps):
+        loss = lm_loss(model, ds.batch(batch))
+        opt.zero_grad(); loss.backward(); opt.step()
+        if log_every and step % log_every == 0:
+            print(f'step {step:3d}  loss {loss.item():.3f}')
+    return model
+
+
+def grpo_stage(model, seed, P=1, G=4, steps=300, lr=1e-4, log_every=0, history=None):
+    """
+    Notebook 02's stage B: `steps` GRPOTrainer updates with tied groups
+    skipped (filter_groups=True), which for P=1 is notebook 02's
+    `grpo_step` plus an optimizer step whenever it returns a loss. Step
+    stats are appended to `history` if given; log_every > 0 prints the
+    exhaustive pass-rate every that many steps and the skipped-group count.
+    """
+    trainer = GRPOTrainer(model, torch.optim.AdamW(model.parameters(), lr=lr), P, G,
+                          filter_groups=True)
+    for step in range(steps):
+        prompts = [random_prompt()[0] for _ in range(P)]
+        st = trainer.step(prompts)
+        if log_every and step % log_every == 0:
+            print(f'step {step:3d}  mean_r {st["mean_reward"]:.2f}  '
+                  f'pass-rate~{exact_pass_rate(model)[0]:.0%}   '
+                  f'e.g. {prompts[0]}{trainer.last_completions[0]}')
+    if log_every:
+        skipped = sum(P - h['groups_used'] for h in trainer.history)
+        print(f'skipped {skipped}/{steps * P} zero-advantage groups ({skipped / (steps * P):.0%})')
+    if history is not None:
+        history.extend(trainer.history)
+    return model